@@ -1,39 +1,168 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
 import sys
 import time
+from array import array
 from bisect import bisect_left
+from multiprocessing import Pipe, Process
 
 # read input file,
 # sort each transaction (to simplify merge)
-def input_process(filename):
-    file = open(filename)
-    TDB = []
+def input_process(filename, end=None):
+    return list(read_transactions(filename, 0, end))
 
-    while True:
-        line = file.readline()
+# iterate sorted transactions of input file in bytes [offset, end)
+# file is read to its end if end is not given
+def read_transactions(filename, offset=0, end=None):
+    file = open(filename, mode='rb')
+    file.seek(offset)
+
+    while end is None or offset < end:
+        line = file.readline() if end is None else file.readline(end-offset)
         if not line:
             break
-        txn = list(map(int, line.split('\t')))
+        offset += len(line)
+        txn = list(map(int, line.split(b'\t')))
         txn.sort()
-        TDB.append(txn)
+        yield txn
     file.close()
-    return TDB
 
-# determine whether B is subset of A
-# using two pointer algorithm, its complexity is O(|A|)
-def having(A, B):
-    i = 0
-    size = len(A)
-    for item in B:
-        while True:
-            if i == size or A[i] > item:
-                return False
-            elif A[i] == item:
-                i+=1    
-                break
-            elif A[i] < item:
-                i+=1
-    return True
-        
+# size of input file up to its last complete line
+# line being appended (without newline yet) is not counted
+def complete_size(filename, block_size=1<<16):
+    file = open(filename, mode='rb')
+    end = file.seek(0, os.SEEK_END)
+    while end > 0:
+        start = max(0, end-block_size)
+        file.seek(start)
+        newline = file.read(end-start).rfind(b'\n')
+        if newline >= 0:
+            file.close()
+            return start + newline + 1
+        end = start
+    file.close()
+    return 0
+
+# compact transaction database (CSR layout)
+# items of all transactions are stored in one flat array,
+# and transaction i is items[offsets[i]:offsets[i+1]]
+# item ids are remapped to dense ids keeping their order, item_ids maps dense id to original id
+class CompactTDB:
+    # Constructor
+    # items, offsets, item_ids can be array or memoryview (memory-mapped cache)
+    def __init__(self, items, offsets, item_ids):
+        self.items = items
+        self.offsets = offsets
+        self.item_ids = item_ids
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    # transaction of given index, or CompactTDB of given slice (copied)
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            start, stop, _ = idx.indices(len(self))
+            stop = max(start, stop)
+            begin = self.offsets[start]
+            end = self.offsets[stop]
+            offsets = array('Q', (offset - begin for offset in self.offsets[start:stop+1]))
+            return CompactTDB(array('I', self.items[begin:end]), offsets, array('q', self.item_ids))
+        return self.items[self.offsets[idx]:self.offsets[idx+1]]
+
+    def __iter__(self):
+        items = self.items
+        offsets = self.offsets
+        for i in range(len(self)):
+            yield items[offsets[i]:offsets[i+1]]
+
+    # map frequent patterns of dense ids back to original item ids
+    def decode(self, frequent_patterns):
+        item_ids = self.item_ids
+        return {tuple(item_ids[item] for item in pattern): frequent_patterns[pattern] for pattern in frequent_patterns}
+
+# read input file (up to end in bytes if given) as CompactTDB
+# file is streamed line by line, only flat arrays are kept in memory
+def input_process_compact(filename, end=None):
+    items = array('I')
+    offsets = array('Q', [0])
+    dense = {}
+
+    for txn in read_transactions(filename, 0, end):
+        for item_id in txn:
+            if not (item_id in dense):
+                dense[item_id] = len(dense)
+            items.append(dense[item_id])
+        offsets.append(len(items))
+
+    # dense ids are given in order of appearance,
+    # remap them in order of original ids so that transactions stay sorted
+    item_ids = sorted(dense)
+    rank = array('I', bytes(4*len(item_ids)))
+    for new_id, item_id in enumerate(item_ids):
+        rank[dense[item_id]] = new_id
+    for i in range(len(items)):
+        items[i] = rank[items[i]]
+
+    return CompactTDB(items, offsets, array('q', item_ids))
+
+# binary cache file of CompactTDB
+# header (magic, size and mtime (ns) of source input file, number of transactions, number of items, number of distinct items)
+# followed by item_ids('q'), offsets('Q'), items('I') in native byte order
+CACHE_MAGIC = b'TDB2'
+CACHE_HEADER = '=4s4xQqQQQ'
+
+# source is (size, mtime in ns) of input file which TDB is read from
+def source_of(filename):
+    stat = os.stat(filename)
+    return stat.st_size, stat.st_mtime_ns
+
+def write_compact_cache(filename, TDB, source):
+    file = open(filename, mode='wb')
+    file.write(struct.pack(CACHE_HEADER, CACHE_MAGIC, source[0], source[1], len(TDB), len(TDB.items), len(TDB.item_ids)))
+    TDB.item_ids.tofile(file)
+    TDB.offsets.tofile(file)
+    TDB.items.tofile(file)
+    file.close()
+
+# memory-map cache file, arrays of CompactTDB are views of mapped file
+# None if it is not cache file or it is made from other source
+def read_compact_cache(filename, source):
+    if os.path.getsize(filename) < struct.calcsize(CACHE_HEADER):
+        return None
+    file = open(filename, mode='rb')
+    buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    file.close()
+
+    magic, source_size, source_mtime, num_txn, num_items, num_distinct = struct.unpack_from(CACHE_HEADER, buf, 0)
+    if magic != CACHE_MAGIC or (source_size, source_mtime) != source:
+        buf.close()
+        return None
+
+    view = memoryview(buf)
+    pos = struct.calcsize(CACHE_HEADER)
+    item_ids = view[pos:pos+8*num_distinct].cast('q')
+    pos += 8*num_distinct
+    offsets = view[pos:pos+8*(num_txn+1)].cast('Q')
+    pos += 8*(num_txn+1)
+    items = view[pos:pos+4*num_items].cast('I')
+
+    return CompactTDB(items, offsets, item_ids)
+
+# read input file through cache file
+# cache is (re)built when it is missing or made from other input file (size or mtime differs)
+def input_process_cached(filename, cache_filename):
+    source = source_of(filename)
+    if os.path.exists(cache_filename):
+        TDB = read_compact_cache(cache_filename, source)
+        if TDB is not None:
+            return TDB
+
+    TDB = input_process_compact(filename)
+    write_compact_cache(cache_filename, TDB, source)
+    return TDB
 
 # get initial frequent pattern set
 def get_frequent_1_itemset(TDB, min_sup):
@@ -52,50 +181,99 @@ def get_frequent_1_itemset(TDB, min_sup):
 
     return patterns
 
+# join frequent patterns sharing (k-2) prefix
+def join_candidates(frequent_patterns):
+    prefix_groups = {}
+    for pattern in sorted(frequent_patterns):
+        prefix = pattern[:-1]
+        if not (prefix in prefix_groups):
+            prefix_groups[prefix] = []
+        prefix_groups[prefix].append(pattern[-1])
+
+    joined = []
+    for prefix, last_items in prefix_groups.items():
+        size = len(last_items)
+        for i in range(size):
+            for j in range(i+1, size):
+                joined.append(prefix + (last_items[i], last_items[j]))
+
+    return joined
+
+# prune joined pattern having infrequent (k-1) subset
+# frequent_set is any container of frequent patterns supporting 'in'
+def prune_candidates(joined, frequent_set):
+    candidates = []
+    for merged_pattern in joined:
+        # subsets dropping one of last two items are joined patterns
+        flag = True
+        for drop in range(len(merged_pattern)-2):
+            if not (merged_pattern[:drop] + merged_pattern[drop+1:] in frequent_set):
+                flag = False
+                break
+        if flag:
+            candidates.append(merged_pattern)
+
+    return candidates
+
 # get candidate for frequent pattern
 # k is candidate's length
-# self merge is used
+# patterns sharing (k-2) prefix are joined,
+# and candidate having infrequent (k-1) subset is pruned
 def get_candidate(frequent_patterns, k):
-    size = len(frequent_patterns)
-    i = 0
-    j = 0
-    candidates = []
-    
-    while i < size:
-        j = 0
-        while j < i:
-            fp1 = frequent_patterns[i]
-            fp2 = frequent_patterns[j]
-            j+=1
-            merged_pattern = tuple(sorted(list(set(fp1+fp2))))
-
-            if len(merged_pattern)!=k:
-                continue
-            flag = 0
-            for pattern in frequent_patterns:
-                if having(merged_pattern, pattern):
-                    flag+=1
-            if flag == k:
-                candidates.append(merged_pattern)
-        i+=1
-    
-    return list(set(candidates))
+    return prune_candidates(join_candidates(frequent_patterns), set(frequent_patterns))
+
+# prefix tree (trie) of candidates with same length
+# each transaction only visits candidates which it can contain
+class CandidateTrie:
+    # Constructor
+    def __init__(self, candidates):
+        self.root = {}
+        self.k = 0
+        for pattern in candidates:
+            self.k = len(pattern)
+            node = self.root
+            for item_id in pattern[:-1]:
+                if not (item_id in node):
+                    node[item_id] = {}
+                node = node[item_id]
+            node[pattern[-1]] = pattern
+
+    # count every candidate contained in sorted transaction
+    def count(self, txn, cnt):
+        k = self.k
+        size = len(txn)
+        stack = [(self.root, 0, 0)]
+        while stack:
+            node, start, depth = stack.pop()
+            # at least (k-depth) items should remain
+            for i in range(start, size - (k-depth) + 1):
+                child = node.get(txn[i])
+                if child is None:
+                    continue
+                if depth+1 == k:
+                    cnt[child] = cnt.get(child, 0) + 1
+                else:
+                    stack.append((child, i+1, depth+1))
+
+# count support of candidates in TDB
+# candidates which no transaction contains are not in result
+def count_support(TDB, candidates):
+    cnt = {}
+    if not candidates:
+        return cnt
+
+    trie = CandidateTrie(candidates)
+    for txn in TDB:
+        trie.count(txn, cnt)
+
+    return cnt
 
 # check whether candidate is frequent or not
 # and gather frequent patterns into one list
 def frequent_filter(TDB, min_sup, candidates):
     num_txn = len(TDB)
     frequent_patterns = {}
-    cnt = {}
-    for txn in TDB:
-        for pattern in candidates:
-            if not having(txn, pattern):
-                continue
-            
-            if not (pattern in cnt):
-               cnt[pattern] = 0
-            
-            cnt[pattern] += 1
+    cnt = count_support(TDB, candidates)
 
     for pattern in cnt:
         if cnt[pattern]/num_txn*100 >= min_sup:
@@ -103,45 +281,426 @@ def frequent_filter(TDB, min_sup, candidates):
 
     return frequent_patterns
 
+# count set bits of bitmap
+# int.bit_count is used if available (python 3.10+), it does not build string of bits
+if hasattr(int, 'bit_count'):
+    def popcount(bits):
+        return bits.bit_count()
+else:
+    def popcount(bits):
+        return bin(bits).count('1')
+
+# get vertical representation of TDB
+# each item is mapped to bitmap of transaction ids (python int) containing it
+def get_tidsets(TDB):
+    size = (len(TDB)+7)//8
+    bitmaps = {}
+    for tid, txn in enumerate(TDB):
+        for item_id in txn:
+            if not (item_id in bitmaps):
+                bitmaps[item_id] = bytearray(size)
+            bitmaps[item_id][tid>>3] |= 1<<(tid&7)
+
+    return {item_id: int.from_bytes(bitmaps[item_id], 'little') for item_id in bitmaps}
+
+# support counting with horizontal TDB
+# each transaction is checked with every candidate
+class HorizontalCounter:
+    # Constructor
+    def __init__(self, TDB):
+        self.TDB = TDB
+        self.scanned_txns = 0
+
+    def frequent_filter(self, min_sup, candidates):
+        if candidates:
+            self.scanned_txns += len(self.TDB)
+        return frequent_filter(self.TDB, min_sup, candidates)
+
+    def close(self):
+        pass
+
+# worker process of ParallelCounter
+# it keeps one shard of TDB, and counts support of candidates given by pipe
+def shard_worker(conn, shard):
+    while True:
+        candidates = conn.recv()
+        if candidates is None:
+            break
+        conn.send(count_support(shard, candidates))
+    conn.close()
+
+# support counting with horizontal TDB partitioned into shards
+# each shard is counted in its own process, and counts are merged before filtering
+class ParallelCounter:
+    # Constructor
+    def __init__(self, TDB, workers):
+        self.num_txn = len(TDB)
+        self.scanned_txns = 0
+        self.conns = []
+        self.processes = []
+
+        shard_size = max(1, (len(TDB)+workers-1)//workers)
+        for start in range(0, len(TDB), shard_size):
+            parent_conn, child_conn = Pipe()
+            process = Process(target=shard_worker, args=(child_conn, TDB[start:start+shard_size]))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(process)
+
+    def frequent_filter(self, min_sup, candidates):
+        frequent_patterns = {}
+        cnt = {}
+        if not candidates:
+            return frequent_patterns
+
+        self.scanned_txns += self.num_txn
+        for conn in self.conns:
+            conn.send(candidates)
+        for conn in self.conns:
+            for pattern, shard_cnt in conn.recv().items():
+                cnt[pattern] = cnt.get(pattern, 0) + shard_cnt
+
+        for pattern in cnt:
+            if cnt[pattern]/self.num_txn*100 >= min_sup:
+                frequent_patterns[pattern] = cnt[pattern]
+
+        return frequent_patterns
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+            conn.close()
+        for process in self.processes:
+            process.join()
+
+# support counting with vertical TDB (tidset bitmaps)
+# support of candidate is popcount of (bitmap of its prefix) AND (bitmap of its last item)
+# bitmaps of frequent patterns are cached for next level
+class VerticalCounter:
+    # Constructor
+    def __init__(self, TDB):
+        self.num_txn = len(TDB)
+        self.tidsets = get_tidsets(TDB)
+        # TDB is scanned only once, to build tidsets
+        self.scanned_txns = self.num_txn
+        self.parent_bitmaps = {(item_id,): bits for item_id, bits in self.tidsets.items()}
+
+    # get bitmap of pattern
+    # cached parent bitmap is used if possible
+    def bitmap_of(self, pattern):
+        bits = self.parent_bitmaps.get(pattern[:-1])
+        if bits is None:
+            bits = self.tidsets.get(pattern[0], 0)
+            for item_id in pattern[1:-1]:
+                bits &= self.tidsets.get(item_id, 0)
+        return bits & self.tidsets.get(pattern[-1], 0)
+
+    def frequent_filter(self, min_sup, candidates):
+        frequent_patterns = {}
+        bitmaps = {}
+        for pattern in candidates:
+            bits = self.bitmap_of(pattern)
+            cnt = popcount(bits)
+            if cnt/self.num_txn*100 >= min_sup:
+                frequent_patterns[pattern] = cnt
+                bitmaps[pattern] = bits
+
+        self.parent_bitmaps = bitmaps
+        return frequent_patterns
+
+    def close(self):
+        pass
+
+COUNTING_ENGINES = {
+    'horizontal': HorizontalCounter,
+    'vertical': VerticalCounter,
+}
+
 # master APRIORI process
 # using all functions above, it returns all frequent patterns
-def APRIORI_process(TDB, min_sup):
+# counting selects support counting engine in COUNTING_ENGINES
+# horizontal counting is run in parallel when workers > 1
+# on_level is called with statistics of each level if it is given
+def APRIORI_process(TDB, min_sup, counting='horizontal', workers=1, on_level=None):
+    start = time.time()
+    if counting == 'horizontal' and workers > 1:
+        counter = ParallelCounter(TDB, workers)
+    else:
+        counter = COUNTING_ENGINES[counting](TDB)
     now_frequent_set = get_frequent_1_itemset(TDB, min_sup)
+    # counting time of level 1 includes building counting engine
+    if on_level is not None:
+        on_level({
+            'level': 1,
+            'joined': None,
+            'candidates': None,
+            'frequent': len(now_frequent_set),
+            'join_time': 0,
+            'prune_time': 0,
+            'count_time': time.time() - start,
+            'scanned_txns': len(TDB),
+        })
+
     frequent_patterns = {}
     k = 1
     while len(now_frequent_set) > 0:
         k+=1
-        candidates = get_candidate(list(now_frequent_set.keys()), k)
+        join_start = time.time()
+        joined = join_candidates(list(now_frequent_set.keys()))
+        prune_start = time.time()
+        candidates = prune_candidates(joined, now_frequent_set)
+        count_start = time.time()
+        scanned_txns = counter.scanned_txns
         frequent_patterns.update(now_frequent_set)
-        now_frequent_set = frequent_filter(TDB, min_sup, candidates)
+        now_frequent_set = counter.frequent_filter(min_sup, candidates)
+        if on_level is not None:
+            on_level({
+                'level': k,
+                'joined': len(joined),
+                'candidates': len(candidates),
+                'frequent': len(now_frequent_set),
+                'join_time': prune_start - join_start,
+                'prune_time': count_start - prune_start,
+                'count_time': time.time() - count_start,
+                'scanned_txns': counter.scanned_txns - scanned_txns,
+            })
+    counter.close()
 
-    return frequent_patterns
+    return sort_patterns(frequent_patterns)
 
-# get association rules from frequent_patterns
-# using bitmask to find all possible subsets
-def get_association_rules(TDB, frequent_patterns):
+# FP-tree node
+# link connects nodes having same item (header table chain)
+class FPNode:
+    # Constructor
+    def __init__(self, item, parent):
+        self.item = item
+        self.count = 0
+        self.parent = parent
+        self.children = {}
+        self.link = None
+
+# FP-tree with header table
+# items in each transaction are inserted in descending frequency order
+class FPTree:
+    # Constructor
+    # order maps item to its rank (smaller rank is more frequent)
+    def __init__(self, order):
+        self.root = FPNode(None, None)
+        self.order = order
+        self.header = {}
+        self.tail = {}
+        self.item_cnt = {}
+
+    # insert ordered item list with its count
+    def insert(self, items, count):
+        node = self.root
+        for item in items:
+            child = node.children.get(item)
+            if child is None:
+                child = FPNode(item, node)
+                node.children[item] = child
+                if item in self.tail:
+                    self.tail[item].link = child
+                else:
+                    self.header[item] = child
+                self.tail[item] = child
+            child.count += count
+            node = child
+            self.item_cnt[item] = self.item_cnt.get(item, 0) + count
+
+    # get conditional pattern base of item
+    # list of (prefix path, count), prefix path is in tree order
+    def prefix_paths(self, item):
+        paths = []
+        node = self.header.get(item)
+        while node is not None:
+            path = []
+            parent = node.parent
+            while parent.item is not None:
+                path.append(parent.item)
+                parent = parent.parent
+            if path:
+                path.reverse()
+                paths.append((path, node.count))
+            node = node.link
+        return paths
+
+# build FP-tree from (items, count) list
+# only items counted at least min_cnt times are kept
+def build_fp_tree(weighted_txns, min_cnt):
+    cnt = {}
+    for items, count in weighted_txns:
+        for item in items:
+            cnt[item] = cnt.get(item, 0) + count
+
+    frequent_items = [item for item in cnt if cnt[item] >= min_cnt]
+    frequent_items.sort(key=lambda item: (-cnt[item], item))
+    order = {item: rank for rank, item in enumerate(frequent_items)}
+
+    tree = FPTree(order)
+    for items, count in weighted_txns:
+        ordered = [item for item in items if item in order]
+        if not ordered:
+            continue
+        ordered.sort(key=lambda item: order[item])
+        tree.insert(ordered, count)
+
+    return tree
+
+# mine FP-tree recursively (pattern growth, no candidate generation)
+# suffix is the pattern which this (conditional) tree is built for
+def fp_growth(tree, suffix, min_cnt, frequent_patterns):
+    for item in sorted(tree.item_cnt, key=lambda item: -tree.order[item]):
+        pattern = tuple(sorted(suffix + (item,)))
+        frequent_patterns[pattern] = tree.item_cnt[item]
+
+        conditional_tree = build_fp_tree(tree.prefix_paths(item), min_cnt)
+        if conditional_tree.item_cnt:
+            fp_growth(conditional_tree, pattern, min_cnt, frequent_patterns)
+
+# master FP-Growth process
+# it returns same frequent patterns with APRIORI_process
+def FPGROWTH_process(TDB, min_sup):
     num_txn = len(TDB)
-    association_rules = []
+    frequent_1_itemset = get_frequent_1_itemset(TDB, min_sup)
+    if not frequent_1_itemset:
+        return {}
+
+    # smallest count satisfying min_sup, same criterion with get_frequent_1_itemset
+    min_cnt = min(frequent_1_itemset.values())
+    while min_cnt > 1 and (min_cnt-1)/num_txn*100 >= min_sup:
+        min_cnt -= 1
+
+    tree = build_fp_tree([(txn, 1) for txn in TDB], min_cnt)
+    frequent_patterns = {}
+    fp_growth(tree, (), min_cnt, frequent_patterns)
+
+    return sort_patterns(frequent_patterns)
+
+# sort frequent patterns by (length, items)
+# so that every mining algorithm gives same output order
+def sort_patterns(frequent_patterns):
+    return {pattern: frequent_patterns[pattern] for pattern in sorted(frequent_patterns, key=lambda p: (len(p), p))}
+
+# get closed frequent patterns
+# pattern is closed if no superset has same support
+# (then no immediate superset has same support, so only those are checked)
+def get_closed_patterns(frequent_patterns):
+    closed_patterns = dict(frequent_patterns)
+    for pattern, cnt in frequent_patterns.items():
+        if len(pattern) < 2:
+            continue
+        for drop in range(len(pattern)):
+            subset = pattern[:drop] + pattern[drop+1:]
+            if frequent_patterns[subset] == cnt:
+                closed_patterns.pop(subset, None)
+
+    return closed_patterns
+
+# get maximal frequent patterns
+# pattern is maximal if no superset is frequent
+def get_maximal_patterns(frequent_patterns):
+    maximal_patterns = dict(frequent_patterns)
     for pattern in frequent_patterns:
-        for bitmask in range(1<<len(pattern)):
-            loop = 0
-            sub1 = ()
-            sub2 = ()
-            while loop < len(pattern) :
-                if bitmask % 2 == 1:
-                    sub1+=(pattern[loop],)
-                else:
-                    sub2+=(pattern[loop],)
-                bitmask //= 2
-                loop+=1
-            if len(sub1)==0 or len(sub2)==0:
+        if len(pattern) < 2:
+            continue
+        for drop in range(len(pattern)):
+            maximal_patterns.pop(pattern[:drop] + pattern[drop+1:], None)
+
+    return maximal_patterns
+
+# support index of closed or maximal patterns
+# iterating gives only closed(maximal) patterns,
+# but support of any frequent pattern can be looked up, and it is derived lazily
+# closed : support is max support of closed supersets
+# maximal : support is counted with tidset bitmaps of TDB
+class SupportIndex:
+    # Constructor
+    def __init__(self, patterns, TDB, closed):
+        self.patterns = patterns
+        self.TDB = TDB
+        self.closed = closed
+        self.cache = dict(patterns)
+        self.item_index = None
+        self.tidsets = None
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def __iter__(self):
+        return iter(self.patterns)
+
+    def __getitem__(self, pattern):
+        if not (pattern in self.cache):
+            if self.closed:
+                self.cache[pattern] = self.superset_support(pattern)
+            else:
+                self.cache[pattern] = self.tidset_support(pattern)
+        return self.cache[pattern]
+
+    def items(self):
+        return self.patterns.items()
+
+    def superset_support(self, pattern):
+        if self.item_index is None:
+            self.item_index = {}
+            for closed_pattern in self.patterns:
+                for item in closed_pattern:
+                    if not (item in self.item_index):
+                        self.item_index[item] = set()
+                    self.item_index[item].add(closed_pattern)
+
+        supersets = sorted((self.item_index.get(item, set()) for item in pattern), key=len)
+        supersets = supersets[0].intersection(*supersets[1:])
+        return max((self.patterns[superset] for superset in supersets), default=0)
+
+    def tidset_support(self, pattern):
+        if self.tidsets is None:
+            self.tidsets = get_tidsets(self.TDB)
+            if isinstance(self.TDB, CompactTDB):
+                self.tidsets = {self.TDB.item_ids[item]: bits for item, bits in self.tidsets.items()}
+
+        bits = self.tidsets.get(pattern[0], 0)
+        for item in pattern[1:]:
+            bits &= self.tidsets.get(item, 0)
+        return popcount(bits)
+
+# get association rules of one frequent pattern
+# consequents are grown level-wise only from confident rules
+# (confidence is anti-monotone on consequent of same pattern)
+# rules are ordered by bitmask of antecedent, same as full subset enumeration
+def get_rules_of(pattern, frequent_patterns, num_txn, min_conf):
+    rules = []
+    support = frequent_patterns[pattern]/num_txn*100
+    position = {item: idx for idx, item in enumerate(pattern)}
+    consequents = [(item,) for item in pattern]
+    k = 1
+    while consequents and k < len(pattern):
+        confident = []
+        for consequent in consequents:
+            antecedent = tuple(item for item in pattern if not (item in consequent))
+            confidence = frequent_patterns[pattern]/frequent_patterns[antecedent]*100
+            if confidence < min_conf:
                 continue
-            support = frequent_patterns[pattern]/num_txn*100
-            confidence = frequent_patterns[pattern]/frequent_patterns[sub1]*100
-            association = (sub1, sub2, support, confidence)
-            association_rules.append(association)
-    
-    return association_rules
+            confident.append(consequent)
+            rules.append((antecedent, consequent, support, confidence))
+        k+=1
+        consequents = get_candidate(confident, k)
+
+    rules.sort(key=lambda association: sum(1<<position[item] for item in association[0]))
+    return rules
+
+# get association rules from frequent_patterns
+# rules having confidence less than min_conf are not generated
+# rules are generated lazily, pattern by pattern
+def get_association_rules(TDB, frequent_patterns, min_conf=0):
+    num_txn = len(TDB)
+    for pattern in frequent_patterns:
+        if len(pattern) < 2:
+            continue
+        yield from get_rules_of(pattern, frequent_patterns, num_txn, min_conf)
 
 # formatting function for item set
 def set_to_str(item_set):
@@ -155,9 +714,12 @@ def set_to_str(item_set):
     return formatted
 
 #write output file
+# it returns number of written association rules
 def output_process(filename, association_rules):
     file = open(filename, mode='w')
+    num_rules = 0
     for association in association_rules:
+        num_rules += 1
         line = set_to_str(association[0])
         line += '\t'
         line += set_to_str(association[1])
@@ -169,18 +731,265 @@ def output_process(filename, association_rules):
 
         file.write(line)
     file.close()
+    return num_rules
            
+# read transactions appended in bytes [offset, end) of input file
+# end should be at end of complete line (see complete_size)
+# it returns TDB of appended transactions and offset of next transaction
+def read_delta(filename, offset, end):
+    return list(read_transactions(filename, offset, end)), end
+
+# count support of patterns, patterns can have different lengths
+def count_support_all(TDB, patterns):
+    levels = {}
+    for pattern in patterns:
+        if not (len(pattern) in levels):
+            levels[len(pattern)] = []
+        levels[len(pattern)].append(pattern)
+
+    cnt = {}
+    for k in levels:
+        cnt.update(count_support(TDB, levels[k]))
+
+    return cnt
+
+# get negative border of frequent patterns
+# infrequent 1-itemsets of given items,
+# and candidates generated from frequent patterns which are not frequent
+def get_negative_border(frequent_patterns, items):
+    border = [(item,) for item in items if not ((item,) in frequent_patterns)]
+    levels = {}
+    for pattern in frequent_patterns:
+        if not (len(pattern) in levels):
+            levels[len(pattern)] = []
+        levels[len(pattern)].append(pattern)
+
+    for k in sorted(levels):
+        for candidate in get_candidate(levels[k], k+1):
+            if not (candidate in frequent_patterns):
+                border.append(candidate)
+
+    return border
+
+# build mining state from mined TDB
+# state keeps frequent patterns and negative border with their counts,
+# and how far input file is processed (offset, num_txn)
+def build_state(TDB, min_sup, frequent_patterns, offset):
+    item_cnt = get_frequent_1_itemset(TDB, 0)
+    border = get_negative_border(frequent_patterns, [pattern[0] for pattern in item_cnt])
+    border_cnt = count_support_all(TDB, [pattern for pattern in border if len(pattern) > 1])
+    border_cnt.update({pattern: item_cnt[pattern] for pattern in border if len(pattern) == 1})
+
+    return {
+        'min_sup': min_sup,
+        'offset': offset,
+        'num_txn': len(TDB),
+        'frequent': dict(frequent_patterns),
+        'border': {pattern: border_cnt.get(pattern, 0) for pattern in border},
+    }
+
+# update mining state with appended transactions (FUP with negative border)
+# only patterns in frequent set and negative border are counted in delta,
+# it returns False if some pattern of negative border becomes frequent
+# (then frequent set can have patterns never counted, so full mining is needed)
+def update_state(state, delta, offset):
+    num_txn = state['num_txn'] + len(delta)
+    min_sup = state['min_sup']
+
+    cnt = dict(state['frequent'])
+    cnt.update(state['border'])
+    for pattern in get_frequent_1_itemset(delta, 0):
+        if not (pattern in cnt):
+            cnt[pattern] = 0
+    for pattern, delta_cnt in count_support_all(delta, list(cnt.keys())).items():
+        cnt[pattern] += delta_cnt
+
+    frequent_patterns = {}
+    for pattern in cnt:
+        if cnt[pattern]/num_txn*100 >= min_sup:
+            if not (pattern in state['frequent']):
+                return False
+            frequent_patterns[pattern] = cnt[pattern]
+
+    border = get_negative_border(frequent_patterns, [pattern[0] for pattern in cnt if len(pattern) == 1])
+    state['offset'] = offset
+    state['num_txn'] = num_txn
+    state['frequent'] = sort_patterns(frequent_patterns)
+    state['border'] = {pattern: cnt[pattern] for pattern in border}
+    return True
+
+# fingerprint of bytes [0, offset) of input file consumed by mining state
+# device and inode of file, and sha256 of first and last block_size bytes of consumed part
+# state is updated incrementally only if fingerprint is unchanged (same file, only appended)
+def fingerprint_of(filename, offset, block_size=1<<12):
+    stat = os.stat(filename)
+    file = open(filename, mode='rb')
+    digest = hashlib.sha256(file.read(min(offset, block_size)))
+    file.seek(max(0, offset-block_size))
+    digest.update(file.read(min(offset, block_size)))
+    file.close()
+
+    return [stat.st_dev, stat.st_ino, digest.hexdigest()]
+
+# read mining state file, None if there is no state file
+def load_state(filename):
+    if not os.path.exists(filename):
+        return None
+    file = open(filename)
+    saved = json.load(file)
+    file.close()
+
+    return {
+        'min_sup': saved['min_sup'],
+        'offset': saved['offset'],
+        'num_txn': saved['num_txn'],
+        'fingerprint': saved.get('fingerprint'),
+        'frequent': {tuple(pattern): cnt for pattern, cnt in saved['frequent']},
+        'border': {tuple(pattern): cnt for pattern, cnt in saved['border']},
+    }
+
+# write mining state file
+def save_state(filename, state):
+    saved = {
+        'min_sup': state['min_sup'],
+        'offset': state['offset'],
+        'num_txn': state['num_txn'],
+        'fingerprint': state['fingerprint'],
+        'frequent': [[list(pattern), cnt] for pattern, cnt in state['frequent'].items()],
+        'border': [[list(pattern), cnt] for pattern, cnt in state['border'].items()],
+    }
+    file = open(filename, mode='w')
+    json.dump(saved, file)
+    file.close()
+
+# split command line arguments into positional arguments and options
+# option is given as '--name value'
+def parse_options(argv, defaults):
+    args = []
+    options = dict(defaults)
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('--') and argv[i][2:] in options and i+1 < len(argv):
+            options[argv[i][2:]] = argv[i+1]
+            i+=2
+        else:
+            args.append(argv[i])
+            i+=1
+
+    return args, options
+
+MINING_ALGORITHMS = ['apriori', 'fpgrowth']
+PATTERN_MODES = ['all', 'closed', 'maximal']
+
+# read input file with reader given by options
+# file is read up to end in bytes if given,
+# cache is not used then since it always holds whole file
+def read_input(filename, options, end=None):
+    if options['cache'] and end is None:
+        return input_process_cached(filename, options['cache'])
+    elif options['reader'] == 'compact' or options['cache']:
+        return input_process_compact(filename, end)
+    return input_process(filename, end)
+
+# mine frequent patterns with algorithm given by options
+# on_level is given to APRIORI_process (FP-Growth has no level)
+def mine(TDB, min_sup, options, on_level=None):
+    if options['algorithm'] == 'fpgrowth':
+        return FPGROWTH_process(TDB, min_sup)
+    return APRIORI_process(TDB, min_sup, options['counting'], int(options['workers']), on_level)
+
+# write statistics of mining process to file as JSON
+def stats_process(filename, stats):
+    file = open(filename, mode='w')
+    json.dump(stats, file, indent=2)
+    file.close()
+
 def main(argv):
+    argv, options = parse_options(argv, {'algorithm': 'apriori', 'counting': 'horizontal', 'workers': '1', 
+                                         'reader': 'text', 'cache': '', 'min-conf': '0', 
+                                         'mode': 'all', 'state': '', 
+                                         'stats': ''})
     if len(argv)<4:
         print('PLEASE, give 3 arguments (minimum support, input filename, output filename)')
+        print('options : --algorithm (apriori, fpgrowth), --counting (horizontal, vertical)')
+        print('          --workers N (apriori with horizontal counting only)')
+        print('          --reader (text, compact), --cache (cache filename of compact reader)')
+        print('          --min-conf (minimum confidence of association rules), --mode (all, closed, maximal)')
+        print('          --state (mining state filename, appended transactions are mined incrementally)')
+        print('          --stats (filename of per-level statistics in JSON)')
+        return
+    if not (options['algorithm'] in MINING_ALGORITHMS):
+        print('Unknown algorithm :', options['algorithm'])
+        return
+    if not (options['counting'] in COUNTING_ENGINES):
+        print('Unknown counting engine :', options['counting'])
+        return
+    if not (options['mode'] in PATTERN_MODES):
+        print('Unknown mode :', options['mode'])
+        return
+    if int(options['workers']) > 1 and (options['algorithm'] != 'apriori' or options['counting'] != 'horizontal'):
+        print('--workers is only supported with horizontal counting of apriori')
         return
     
-    TDB = input_process(argv[2])
+    min_sup = float(argv[1])
+    levels = []
+    if options['state']:
+        if options['mode'] == 'maximal':
+            print('maximal mode is not supported with --state')
+            return
+        start = time.time()
+        state = load_state(options['state'])
+        updated = False
+        # only complete lines are mined, line being appended is left for next run
+        offset = complete_size(argv[2])
+        if offset < os.path.getsize(argv[2]):
+            print('Warning : last line of input file has no newline, it is not mined until it is complete')
+        if state is not None and state['min_sup'] == min_sup and offset >= state['offset'] \
+           and state['fingerprint'] == fingerprint_of(argv[2], state['offset']):
+            delta, offset = read_delta(argv[2], state['offset'], offset)
+            updated = update_state(state, delta, offset)
+        if not updated:
+            TDB = read_input(argv[2], options, offset)
+            state = build_state(TDB, min_sup, mine(TDB, min_sup, options, levels.append), offset)
+            if isinstance(TDB, CompactTDB):
+                state['frequent'] = TDB.decode(state['frequent'])
+                state['border'] = TDB.decode(state['border'])
+        state['fingerprint'] = fingerprint_of(argv[2], state['offset'])
+        save_state(options['state'], state)
+        frequent_patterns = state['frequent']
+        # only the size of TDB is needed for rule generation
+        TDB = range(state['num_txn'])
+    else:
+        TDB = read_input(argv[2], options)
+        start = time.time()
+        frequent_patterns = mine(TDB, min_sup, options, levels.append)
+        if isinstance(TDB, CompactTDB):
+            frequent_patterns = TDB.decode(frequent_patterns)
+    if options['mode'] == 'closed':
+        frequent_patterns = SupportIndex(get_closed_patterns(frequent_patterns), TDB, True)
+    elif options['mode'] == 'maximal':
+        frequent_patterns = SupportIndex(get_maximal_patterns(frequent_patterns), TDB, False)
+    mining_time = time.time()-start
+    print('Apriori Time:', mining_time)
+
     start = time.time()
-    frequent_patterns = APRIORI_process(TDB, float(argv[1]))
-    association_rules = get_association_rules(TDB, frequent_patterns)
-    print('Apriori Time:', time.time()-start)
-    output_process(argv[3], association_rules)
+    association_rules = get_association_rules(TDB, frequent_patterns, float(options['min-conf']))
+    num_rules = output_process(argv[3], association_rules)
+    rule_time = time.time()-start
+    print('Rule and Output Time:', rule_time)
+
+    if options['stats']:
+        stats_process(options['stats'], {
+            'algorithm': options['algorithm'],
+            'counting': options['counting'],
+            'min_sup': min_sup,
+            'num_txn': len(TDB),
+            'levels': levels,
+            'frequent_patterns': len(frequent_patterns),
+            'mining_time': mining_time,
+            'rules': num_rules,
+            'rule_time': rule_time,
+        })
 
 if __name__ == '__main__':
     main(sys.argv)
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import apriori
+import data_generator
+
+# default benchmark grid
+# every combination of dataset parameters is generated and mined at every min_sup
+DATASET_GRID = {
+    'generator': ['uniform', 'quest'],
+    'num_txn': [1000, 10000],
+    'num_item': [20, 100],
+    'len_txn': [10],
+}
+MIN_SUPS = [10, 5, 3]
+ENGINES = [
+    ('apriori', 'horizontal'),
+    ('apriori', 'vertical'),
+    ('fpgrowth', None),
+]
+
+# all combinations of dataset parameters
+def get_datasets(grid):
+    datasets = [{}]
+    for key in grid:
+        datasets = [dict(dataset, **{key: value}) for dataset in datasets for value in grid[key]]
+
+    return datasets
+
+# mine frequent patterns with one engine
+# on_level is called with statistics of each level (Apriori only)
+def run_miner(TDB, min_sup, algorithm, counting, on_level=None):
+    if algorithm == 'fpgrowth':
+        return apriori.FPGROWTH_process(TDB, min_sup)
+    return apriori.APRIORI_process(TDB, min_sup, counting, on_level=on_level)
+
+# sha256 of output file made from frequent patterns
+# it is used to check that outputs are identical across runs and engines
+def digest_of(TDB, frequent_patterns, output_filename):
+    apriori.output_process(output_filename, apriori.get_association_rules(TDB, frequent_patterns))
+    file = open(output_filename, mode='rb')
+    digest = hashlib.sha256(file.read()).hexdigest()
+    file.close()
+
+    return digest
+
+# number of frequent patterns of each length
+def patterns_per_level(frequent_patterns):
+    levels = {}
+    for pattern in frequent_patterns:
+        levels[len(pattern)] = levels.get(len(pattern), 0) + 1
+
+    return {str(k): levels[k] for k in sorted(levels)}
+
+# run one engine repeatedly and record timings, peak memory and patterns found
+# per-level statistics of last run are recorded
+# peak memory is measured in separate run, since tracemalloc slows down mining
+def benchmark_engine(TDB, min_sup, algorithm, counting, repeat, output_filename):
+    times = []
+    digests = []
+    for _ in range(repeat):
+        levels = []
+        start = time.time()
+        frequent_patterns = run_miner(TDB, min_sup, algorithm, counting, levels.append)
+        times.append(time.time()-start)
+        digests.append(digest_of(TDB, frequent_patterns, output_filename))
+
+    tracemalloc.start()
+    run_miner(TDB, min_sup, algorithm, counting)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'algorithm': algorithm,
+        'counting': counting,
+        'min_sup': min_sup,
+        'times': times,
+        'time': min(times),
+        'peak_memory': peak_memory,
+        'patterns': len(frequent_patterns),
+        'patterns_per_level': patterns_per_level(frequent_patterns),
+        'levels': levels,
+        'digest': digests[0],
+        'identical': len(set(digests)) == 1,
+    }
+
+# generate dataset and benchmark every engine at every min_sup
+# outputs of all engines at same min_sup should be identical
+def benchmark_dataset(dataset, min_sups, engines, repeat, work_dir):
+    generator = data_generator.GENERATORS[dataset['generator']]
+    TDB = generator(dataset['num_txn'], dataset['num_item'], dataset['len_txn'])
+    input_filename = os.path.join(work_dir, 'input.txt')
+    output_filename = os.path.join(work_dir, 'output.txt')
+    data_generator.output_process(input_filename, TDB)
+    TDB = apriori.input_process(input_filename)
+
+    records = []
+    for min_sup in min_sups:
+        digests = set()
+        for algorithm, counting in engines:
+            record = benchmark_engine(TDB, min_sup, algorithm, counting, repeat, output_filename)
+            record['dataset'] = dataset
+            records.append(record)
+            digests.add(record['digest'])
+            print(dataset, min_sup, algorithm, counting, 'Time : %f sec' % record['time'])
+
+        for record in records[-len(engines):]:
+            record['identical'] = record['identical'] and len(digests) == 1
+
+    return records
+
+def main(argv):
+    argv, options = apriori.parse_options(argv, {'repeat': '3', 'seed': '0'})
+    if len(argv)<2:
+        print('PLEASE, give 1 argument (result filename)')
+        print('options : --repeat N, --seed N')
+        return
+
+    random.seed(int(options['seed']))
+    records = []
+    work_dir = tempfile.mkdtemp()
+    for dataset in get_datasets(DATASET_GRID):
+        records += benchmark_dataset(dataset, MIN_SUPS, ENGINES, int(options['repeat']), work_dir)
+    shutil.rmtree(work_dir)
+
+    file = open(argv[1], mode='w')
+    json.dump(records, file, indent=2)
+    file.close()
+
+    mismatched = [record for record in records if not record['identical']]
+    print('Mismatched Outputs :', len(mismatched))
+
+if __name__ == '__main__':
+    main(sys.argv)
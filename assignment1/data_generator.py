@@ -14,11 +14,73 @@ def output_process(filename, TDB):
 
     file.close()
 
+# uniform random transactions
+# each transaction is random subset of items, its length is in [1, len_txn]
+def generate_uniform(num_txn, num_item, len_txn):
+    txn = list(range(num_item))
+
+    TDB = []
+
+    for _ in range(num_txn):
+        random.shuffle(txn)
+        TDB.append(txn[:random.randint(1, len_txn)])
+
+    return TDB
+
+# skewed transactions like IBM Quest generator
+# transactions are made of potential patterns (correlated itemsets),
+# patterns are picked with exponentially distributed weights,
+# each pattern shares some items with previous one, and items of pattern are dropped with corruption level
+def generate_quest(num_txn, num_item, len_txn, num_pattern=None, len_pattern=4, correlation=0.5):
+    if num_pattern is None:
+        num_pattern = max(1, num_item // 2)
+
+    patterns = []
+    weights = []
+    corruptions = []
+    prev_pattern = []
+    for _ in range(num_pattern):
+        size = max(1, min(num_item, int(random.expovariate(1/len_pattern))+1))
+        num_shared = min(len(prev_pattern), int(size*random.random()*correlation*2))
+        pattern = set(random.sample(prev_pattern, num_shared))
+        while len(pattern) < size:
+            pattern.add(random.randrange(num_item))
+        pattern = list(pattern)
+        patterns.append(pattern)
+        weights.append(random.expovariate(1))
+        corruptions.append(min(1, max(0, random.normalvariate(0.5, 0.1))))
+        prev_pattern = pattern
+
+    # transaction can not be longer than number of distinct items in patterns
+    max_size = min(len_txn, len(set().union(*patterns)))
+
+    TDB = []
+
+    for _ in range(num_txn):
+        size = random.randint(1, max_size)
+        txn = set()
+        while len(txn) < size:
+            idx = random.choices(range(num_pattern), weights)[0]
+            for item in patterns[idx]:
+                if random.random() >= corruptions[idx]:
+                    txn.add(item)
+            if len(txn) == 0:
+                txn.add(random.choice(patterns[idx]))
+        TDB.append(list(txn)[:size])
+
+    return TDB
+
+GENERATORS = {
+    'uniform': generate_uniform,
+    'quest': generate_quest,
+}
+
 def main(argv):
     filename = 'input.txt'
     num_txn = 500
     num_item = 20
     len_txn = 10
+    generator = 'uniform'
 
     if len(argv)>1:
         filename = argv[1]
@@ -28,16 +90,16 @@ def main(argv):
         num_item = int(argv[3])
     if len(argv)>4:
         len_txn = int(argv[4])
+    if len(argv)>5:
+        generator = argv[5]
 
-    txn = list(range(num_item))
-
-    TDB = []
+    if not (generator in GENERATORS):
+        print('Unknown generator :', generator)
+        return
 
-    for _ in range(num_txn):
-        random.shuffle(txn)
-        TDB.append(txn[:random.randint(1, len_txn)])
+    TDB = GENERATORS[generator](num_txn, num_item, len_txn)
 
     output_process(filename, TDB)
     
 if __name__ == '__main__':
-    main(sys.argv)
\ No newline at end of file
+    main(sys.argv)
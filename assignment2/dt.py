@@ -1,109 +1,307 @@
+import json
 import sys
 import time
+from collections import deque
+from itertools import islice
+from multiprocessing import Pool, shared_memory
 import numpy as np
 
+# smallest unsigned integer type which can hold codes of given number of values
+def code_dtype(num_values):
+    if num_values <= np.iinfo(np.uint8).max:
+        return np.uint8
+    if num_values <= np.iinfo(np.uint16).max:
+        return np.uint16
+    return np.uint32
+
+# Dictionary-Encoded Training Set Class
+# codes is (attribute x row) array, each attribute column is encoded into codes of its sorted values,
+# and last row of codes is class label codes
+# Decision Tree is built on index array of rows, so rows are never copied
+# without codes (loaded model), it only keeps dictionaries to encode test data
+class EncodedSet:
+    # Constructor
+    def __init__(self, class_labels, attr_values, codes=None):
+        self.class_labels = class_labels
+        self.attr_values = attr_values
+        self.codes = codes
+        if codes is not None:
+            self.columns = codes[:-1]
+            self.label_codes = codes[-1]
+
+    def num_rows(self):
+        return self.codes.shape[1]
+
+    # encode 2D array of test data (row x attribute) at once
+    def encode_batch(self, data_set):
+        codes = np.full(data_set.shape, -1, dtype=np.int32)
+        for attr_idx, attr_values in enumerate(self.attr_values):
+            column = data_set.T[attr_idx]
+            column_codes = np.minimum(np.searchsorted(attr_values, column), attr_values.size-1)
+            known = attr_values[column_codes] == column
+            codes.T[attr_idx][known] = column_codes[known]
+
+        return codes
+
 # Decision Tree Class
+# tree is stored as flat arrays indexed by node id (root is 0)
+# attr_idx : test attribute of node, -1 for leaf
+# class_label : (major) class label code of node
+# child_offset : children of node are child_table[child_offset[node] + value code], -1 if pruned
 class DT:
     # Constructor
-    # mask is set of already used attribute index
-    def __init__(self, mask):
-        self.child = {}
+    # if max_features is given, each node only tests that many randomly chosen attributes (random forest)
+    def __init__(self, max_features=None, seed=None):
         self.attr_idx = None
-        self.mask = set()
-        self.mask.update(mask)
         self.class_label = None
+        self.child_offset = None
+        self.child_table = None
         self.majority_threshold = 0.8
         self.pruning_threshold = 0.05
+        self.max_features = max_features
+        self.rng = np.random.default_rng(seed)
 
-    # evaluate entropy of dataset
-    def entropy_of(self, class_labels, data_set):
+    # evaluate entropy from class label counts
+    def entropy_of(self, label_counts):
         entropy = 0
-        data_labels = data_set.T[-1]
-        for label in class_labels:
-            p_i = np.sum(data_labels==label)/data_labels.size
-            if p_i==0:
+        total = label_counts.sum()
+        for cnt in label_counts:
+            if cnt==0:
                 continue
+            p_i = cnt/total
             entropy += p_i*np.log2(p_i)
 
         return -entropy
 
     # evaluate entropy of splited dataset
-    def entropy_with_attr_of(self, class_labels, data_set, attr_idx):
+    # table is (attribute value x class label) contingency table
+    # attribute value not in dataset is skipped
+    def entropy_with_attr_of(self, table):
         entropy = 0
-        attr_values = np.unique(data_set.T[attr_idx])
+        value_counts = table.sum(axis=1)
+        total = value_counts.sum()
 
-        for attr in attr_values:
-            data_subset = data_set[data_set.T[attr_idx]==attr]
-            p_i = data_subset.shape[0]/data_set.shape[0]
-            entropy += p_i*self.entropy_of(class_labels, data_subset)
+        for value_idx in range(table.shape[0]):
+            if value_counts[value_idx]==0:
+                continue
+            p_i = value_counts[value_idx]/total
+            entropy += p_i*self.entropy_of(table[value_idx])
 
         return entropy
+
+    # (attribute value x class label) contingency table of attribute
+    # it is built with single bincount over integer-encoded column
+    def contingency_table(self, num_values, num_labels, value_codes, label_codes):
+        table = np.bincount(value_codes.astype(np.intp)*num_labels + label_codes, 
+                            minlength=num_values*num_labels)
+        
+        return table.reshape(num_values, num_labels)
     
     # majority voting
-    # return major class label and its ratio
-    def major_label_of(self, class_labels, data_set):
-        major_label = None
-        max_cnt = 0
-        data_labels = data_set.T[-1]
-        for label in class_labels:
-            cnt = np.sum(data_labels==label)
-            if cnt > max_cnt:
-                max_cnt = cnt
-                major_label = label
-
-        return major_label, max_cnt/data_labels.size
-
-    # construct Decision Tree recursively
-    # pruning with majority_threshold and pruning_threshold
-    def construct(self, attributes, class_labels, data_set):
-        if self.entropy_of(class_labels, data_set) == 0:
-            self.class_label = data_set[0][-1]
-            return
+    # return major class label code and its ratio
+    def major_label_of(self, label_counts):
+        major_label = label_counts.argmax()
+
+        return major_label, label_counts[major_label]/label_counts.sum()
+
+    # decide class label and test attribute of node
+    # node is made with rows order[start:end], mask is bitmask of already used attribute index
+    # pruning with majority_threshold
+    # returns class label code, test attribute index (None for leaf) and counts of each value of it
+    def split_of(self, encoded_set, order, start, end, mask):
+        num_attrs = len(encoded_set.columns)
+        num_labels = encoded_set.class_labels.size
+        rows = order[start:end]
+        label_codes = encoded_set.label_codes[rows]
+        label_counts = np.bincount(label_codes, minlength=num_labels)
+        parent_entropy = self.entropy_of(label_counts)
+        if parent_entropy == 0:
+            return label_codes[0], None, None
         
-        self.class_label, ratio = self.major_label_of(class_labels, data_set)
-        if len(self.mask) == attributes.size - 1 or ratio > self.majority_threshold:
-            return
+        class_label, ratio = self.major_label_of(label_counts)
+        if mask == (1<<num_attrs)-1 or ratio > self.majority_threshold:
+            return class_label, None, None
 
         test_attr_idx = None
         max_info_gain = 0
+        value_counts = None
 
-        for attr_idx in range(attributes.size - 1):
-            if attr_idx in self.mask:
-                continue
-            
-            info_gain = self.entropy_of(class_labels, data_set) - self.entropy_with_attr_of(class_labels, data_set, attr_idx)
+        candidates = [attr_idx for attr_idx in range(num_attrs) if not (mask & (1<<attr_idx))]
+        if self.max_features is not None and len(candidates) > self.max_features:
+            candidates = sorted(self.rng.choice(candidates, self.max_features, replace=False).tolist())
+
+        for attr_idx in candidates:
+            num_values = encoded_set.attr_values[attr_idx].size
+            table = self.contingency_table(num_values, num_labels, encoded_set.columns[attr_idx][rows], label_codes)
+            info_gain = parent_entropy - self.entropy_with_attr_of(table)
             if info_gain > max_info_gain:
                 max_info_gain = info_gain
                 test_attr_idx = attr_idx
-        
-        new_mask = set()
-        new_mask.update(self.mask)
-        new_mask.add(test_attr_idx)
+                value_counts = table.sum(axis=1)
 
-        self.attr_idx = test_attr_idx
-        attr_values = np.unique(data_set.T[test_attr_idx])
-        
-        for attr in attr_values:
-            data_subset = data_set[data_set.T[test_attr_idx]==attr]
-            subset_ratio = data_subset.shape[0]/data_set.shape[0]
-            if subset_ratio < self.pruning_threshold:
+        return class_label, test_attr_idx, value_counts
+
+    # construct Decision Tree with explicit work queue
+    # each work is (node id, start, end, mask), node is built with rows order[start:end]
+    # order is index array of rows, which is partitioned in place
+    # pruning with majority_threshold and pruning_threshold
+    def construct(self, encoded_set, order):
+        attr_idx = [-1]
+        class_label = [0]
+        child_offset = [-1]
+        child_table = []
+
+        queue = deque([(0, 0, order.size, 0)])
+        while queue:
+            node, start, end, mask = queue.popleft()
+            class_label[node], test_attr_idx, value_counts = self.split_of(encoded_set, order, start, end, mask)
+            # no attribute gives information, this node is leaf
+            if test_attr_idx is None:
                 continue
-            new_leaf = DT(new_mask)
 
-            new_leaf.construct(attributes, class_labels, data_subset)
-            self.child[attr] = new_leaf
+            attr_idx[node] = test_attr_idx
+            child_offset[node] = len(child_table)
+            child_table.extend([-1]*value_counts.size)
 
-    # predict unknown class label of given data
-    def classify(self, data):
-        if self.attr_idx == None:
-            return self.class_label
-        
-        attr = data[self.attr_idx]
+            # partition rows of this node by value of test attribute (stable sort)
+            # then rows of each attribute value are contiguous
+            rows = order[start:end]
+            value_codes = encoded_set.columns[test_attr_idx][rows]
+            order[start:end] = rows[np.argsort(value_codes, kind='stable')]
+            
+            child_start = start
+            for value_code in range(value_counts.size):
+                child_end = child_start + value_counts[value_code]
+                subset_ratio = value_counts[value_code]/(end-start)
+                if value_counts[value_code]==0 or subset_ratio < self.pruning_threshold:
+                    child_start = child_end
+                    continue
+                child = len(attr_idx)
+                attr_idx.append(-1)
+                class_label.append(0)
+                child_offset.append(-1)
+                child_table[child_offset[node] + value_code] = child
+
+                queue.append((child, child_start, child_end, mask | (1<<test_attr_idx)))
+                child_start = child_end
+
+        self.attr_idx = np.array(attr_idx, dtype=np.int32)
+        self.class_label = np.array(class_label, dtype=np.int32)
+        self.child_offset = np.array(child_offset, dtype=np.int32)
+        self.child_table = np.array(child_table, dtype=np.int32)
+
+    # predict class label codes of encoded data (row x attribute) at once
+    # all rows are moved down one level per step with vectorized masks
+    def predict_batch(self, data_set):
+        node = np.zeros(data_set.shape[0], dtype=np.int32)
+        active = np.arange(data_set.shape[0])
+        while active.size > 0:
+            attrs = self.attr_idx[node[active]]
+            active = active[attrs >= 0]
+            attrs = attrs[attrs >= 0]
 
-        if not (attr in self.child):
-            return self.class_label
+            value_codes = data_set[active, attrs]
+            child = np.full(active.size, -1, dtype=np.int32)
+            known = value_codes >= 0
+            child[known] = self.child_table[self.child_offset[node[active[known]]] + value_codes[known]]
 
-        return self.child[attr].classify(data)
+            node[active[child >= 0]] = child[child >= 0]
+            active = active[child >= 0]
+
+        return self.class_label[node]
+
+# training set shared by worker processes of RandomForest
+worker_set = None
+worker_memory = None
+
+# attach training set codes in shared memory (run in worker process)
+def init_worker(memory_name, shape, dtype, class_labels, attr_values):
+    global worker_set, worker_memory
+    worker_memory = shared_memory.SharedMemory(name=memory_name)
+    codes = np.ndarray(shape, dtype=dtype, buffer=worker_memory.buf)
+    worker_set = EncodedSet(class_labels, attr_values, codes)
+
+# build one tree of RandomForest on bootstrap sample
+# bootstrap sample and attribute subsets are drawn from independent child seeds of seed
+# encoded_set is worker_set if it is not given
+def build_bootstrap_tree(args):
+    seed, max_features, encoded_set = args
+    if encoded_set is None:
+        encoded_set = worker_set
+    bootstrap_seed, tree_seed = np.random.SeedSequence(seed).spawn(2)
+    rng = np.random.default_rng(bootstrap_seed)
+    order = rng.integers(0, encoded_set.num_rows(), encoded_set.num_rows())
+
+    decision_tree = DT(max_features, tree_seed)
+    decision_tree.construct(encoded_set, order)
+
+    return decision_tree
+
+# Random Forest Class
+# Decision Trees are built on bootstrap samples with random attribute subsets,
+# and class label is decided by majority voting of trees
+class RandomForest:
+    # Constructor
+    # default max_features is square root of number of attributes
+    def __init__(self, num_trees, max_features=None, seed=0):
+        self.num_trees = num_trees
+        self.max_features = max_features
+        self.seed = seed
+        self.trees = []
+        self.num_labels = None
+
+    # build trees in process pool of given number of workers
+    # training set codes are placed in shared memory, instead of being copied to each worker
+    def construct(self, encoded_set, workers=1):
+        self.num_labels = encoded_set.class_labels.size
+        max_features = self.max_features
+        if max_features is None:
+            max_features = int(np.ceil(np.sqrt(len(encoded_set.attr_values))))
+        seeds = np.random.SeedSequence(self.seed).generate_state(self.num_trees)
+
+        if workers <= 1:
+            self.trees = [build_bootstrap_tree((seed, max_features, encoded_set)) for seed in seeds]
+            return
+
+        memory = shared_memory.SharedMemory(create=True, size=encoded_set.codes.nbytes)
+        codes = np.ndarray(encoded_set.codes.shape, dtype=encoded_set.codes.dtype, buffer=memory.buf)
+        codes[:] = encoded_set.codes
+        pool = Pool(workers, 
+                    initializer=init_worker, 
+                    initargs=(memory.name, codes.shape, codes.dtype.str, encoded_set.class_labels, encoded_set.attr_values))
+        self.trees = pool.map(build_bootstrap_tree, [(seed, max_features, None) for seed in seeds])
+        pool.close()
+        pool.join()
+
+        del codes
+        memory.close()
+        memory.unlink()
+
+    # predict class label codes of encoded data (row x attribute) at once
+    # ties of voting go to smaller class label code
+    def predict_batch(self, data_set):
+        votes = np.zeros((data_set.shape[0], self.num_labels), dtype=np.int32)
+        rows = np.arange(data_set.shape[0])
+        for decision_tree in self.trees:
+            votes[rows, decision_tree.predict_batch(data_set)] += 1
+
+        return votes.argmax(axis=1)
+
+# encode training set once before building
+# every column shares smallest integer type which can hold all of its codes
+def encode_training_set(attributes, class_labels, training_set):
+    attr_values = []
+    columns = []
+    for attr_idx in range(attributes.size - 1):
+        values, codes = np.unique(training_set.T[attr_idx], return_inverse=True)
+        attr_values.append(values)
+        columns.append(codes)
+    columns.append(np.searchsorted(class_labels, training_set.T[-1]))
+
+    num_codes = max([values.size for values in attr_values] + [class_labels.size])
+    codes = np.array(columns, dtype=code_dtype(num_codes))
+
+    return EncodedSet(class_labels, attr_values, codes)
 
 # read input file
 # Since DT algorithm in this source code is using vector operation with numpy,
@@ -133,13 +331,115 @@ def input_training_set(filename):
 
 # master Decision Tree Building Process
 # using DT class, it returns a Decision Tree instance
-def build_decision_tree(attributes, class_labels, training_set):
-    decision_tree = DT(set())
+def build_decision_tree(encoded_set):
+    decision_tree = DT()
 
-    decision_tree.construct(attributes, class_labels, training_set)
+    decision_tree.construct(encoded_set, np.arange(encoded_set.num_rows()))
     
     return decision_tree
 
+# Random Forest Building Process
+# it returns a Random Forest instance, which can be used like Decision Tree
+def build_random_forest(encoded_set, num_trees, workers, seed):
+    random_forest = RandomForest(num_trees, seed=seed)
+
+    random_forest.construct(encoded_set, workers)
+
+    return random_forest
+
+# binary model file
+# magic, length of JSON header, JSON header, then node arrays (int32) of each tree
+# JSON header keeps attributes, class labels, attribute dictionaries and offsets of node arrays
+# every array starts at 8-byte aligned offset, so arrays can be used directly from memory-mapped file
+MODEL_MAGIC = b'DTM1'
+MODEL_ARRAYS = ['attr_idx', 'class_label', 'child_offset', 'child_table']
+
+def align8(size):
+    return (size+7)//8*8
+
+# write Decision Tree or Random Forest with its dictionaries to model file
+def save_model(filename, attributes, encoded_set, decision_tree):
+    trees = [decision_tree]
+    if isinstance(decision_tree, RandomForest):
+        trees = decision_tree.trees
+
+    tree_offsets = []
+    offset = 0
+    for tree in trees:
+        offsets = {}
+        for name in MODEL_ARRAYS:
+            offsets[name] = [offset, getattr(tree, name).size]
+            offset += align8(getattr(tree, name).nbytes)
+        tree_offsets.append(offsets)
+
+    header = json.dumps({
+        'attributes': attributes.tolist(),
+        'class_labels': encoded_set.class_labels.tolist(),
+        'attr_values': [attr_values.tolist() for attr_values in encoded_set.attr_values],
+        'forest': isinstance(decision_tree, RandomForest),
+        'trees': tree_offsets,
+    }).encode()
+
+    file = open(filename, mode='wb')
+    file.write(MODEL_MAGIC)
+    file.write(np.array([len(header)], dtype='<u4').tobytes())
+    file.write(header)
+    file.write(bytes(align8(8+len(header)) - 8 - len(header)))
+    for tree in trees:
+        for name in MODEL_ARRAYS:
+            data = getattr(tree, name).astype('<i4').tobytes()
+            file.write(data)
+            file.write(bytes(align8(len(data)) - len(data)))
+    file.close()
+
+# read model file, node arrays are views of memory-mapped file
+# returns attributes, dictionary-only EncodedSet and Decision Tree (or Random Forest)
+def load_model(filename):
+    buf = np.memmap(filename, dtype=np.uint8, mode='r')
+    if bytes(buf[:4]) != MODEL_MAGIC:
+        print('Invalid model file :', filename)
+        return None, None, None
+    header_size = int(buf[4:8].view('<u4')[0])
+    header = json.loads(bytes(buf[8:8+header_size]).decode())
+    data_start = align8(8+header_size)
+
+    trees = []
+    for offsets in header['trees']:
+        tree = DT()
+        for name in MODEL_ARRAYS:
+            offset, size = offsets[name]
+            start = data_start + offset
+            setattr(tree, name, buf[start:start+4*size].view('<i4'))
+        trees.append(tree)
+
+    attributes = np.array(header['attributes'])
+    class_labels = np.array(header['class_labels'])
+    encoded_set = EncodedSet(class_labels, [np.array(attr_values) for attr_values in header['attr_values']])
+
+    if not header['forest']:
+        return attributes, encoded_set, trees[0]
+
+    random_forest = RandomForest(len(trees))
+    random_forest.trees = trees
+    random_forest.num_labels = class_labels.size
+    return attributes, encoded_set, random_forest
+
+# split command line arguments into positional arguments and options
+# option is given as '--name value'
+def parse_options(argv, defaults):
+    args = []
+    options = dict(defaults)
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('--') and argv[i][2:] in options and i+1 < len(argv):
+            options[argv[i][2:]] = argv[i+1]
+            i+=2
+        else:
+            args.append(argv[i])
+            i+=1
+
+    return args, options
+
 # formatting function for numpy array with string
 def array_to_str(arr):
     result = ''
@@ -152,7 +452,9 @@ def array_to_str(arr):
     return result
 
 # read test file and write test result to output file
-def test_and_output(attributes, decision_tree, test_filename, output_filename): 
+# test file is read and classified in chunks of chunk_size rows,
+# test data is encoded with dictionaries of encoded_set, and label is decoded at output
+def test_and_output(attributes, decision_tree, encoded_set, test_filename, output_filename, chunk_size=1<<16): 
     test_file = open(test_filename)
     output_file = open(output_filename, mode='w')
 
@@ -160,31 +462,58 @@ def test_and_output(attributes, decision_tree, test_filename, output_filename):
     output_file.write(array_to_str(attributes))
 
     while True:
-        line = test_file.readline()
-        if not line:
+        lines = [line.strip() for line in islice(test_file, chunk_size)]
+        if not lines:
             break
-        data = np.array(line.strip().split('\t'))
+        data_set = np.array([line.split('\t') for line in lines])
 
-        class_label = decision_tree.classify(data)
-        data = np.append(data, class_label)
-        output_file.write(array_to_str(data))
+        label_codes = decision_tree.predict_batch(encoded_set.encode_batch(data_set))
+        class_labels = encoded_set.class_labels[label_codes]
+        output_file.write(''.join([line + '\t' + label + '\n' for line, label in zip(lines, class_labels)]))
     
     test_file.close()
     output_file.close()
 
 def main(argv):
-    if len(argv)<4:
-        print('PLEASE, give 3 arguments (training filename, test filename, output filename)')
+    argv, options = parse_options(argv, {'trees': '1', 'workers': '1', 'seed': '0', 
+                                         'save-model': '', 'load-model': ''})
+    if int(options['workers']) > 1 and (options['load-model'] or int(options['trees']) <= 1):
+        print('--workers is only supported when building random forest (--trees N with N > 1)')
         return
-    attributes, class_labels, training_set = input_training_set(argv[1])
-    
-    sys.setrecursionlimit(max(attributes.size*10, 10000))
-    train_start = time.time()
-    decision_tree = build_decision_tree(attributes, class_labels, training_set)
-    train_end = time.time()
-    print('Building Time : %f sec' % (train_end-train_start))
+    if options['load-model']:
+        if len(argv)<3:
+            print('PLEASE, give 2 arguments with --load-model (test filename, output filename)')
+            return
+        load_start = time.time()
+        attributes, encoded_set, decision_tree = load_model(options['load-model'])
+        if decision_tree is None:
+            return
+        load_end = time.time()
+        print('Loading Time : %f sec' % (load_end-load_start))
+        test_filename, output_filename = argv[1], argv[2]
+    else:
+        if len(argv)<4:
+            print('PLEASE, give 3 arguments (training filename, test filename, output filename)')
+            print('options : --trees N (random forest if N > 1), --workers N (random forest only), --seed N')
+            print('          --save-model (model filename), --load-model (model filename, training file is not given)')
+            return
+        attributes, class_labels, training_set = input_training_set(argv[1])
+
+        train_start = time.time()
+        encoded_set = encode_training_set(attributes, class_labels, training_set)
+        del training_set
+        if int(options['trees']) > 1:
+            decision_tree = build_random_forest(encoded_set, int(options['trees']), int(options['workers']), int(options['seed']))
+        else:
+            decision_tree = build_decision_tree(encoded_set)
+        train_end = time.time()
+        print('Building Time : %f sec' % (train_end-train_start))
+        if options['save-model']:
+            save_model(options['save-model'], attributes, encoded_set, decision_tree)
+        test_filename, output_filename = argv[2], argv[3]
+
     test_start = time.time()
-    test_and_output(attributes, decision_tree, argv[2], argv[3])
+    test_and_output(attributes, decision_tree, encoded_set, test_filename, output_filename)
     test_end = time.time()
     print('Testing Time : %f sec' % (test_end-test_start))
 
@@ -2,82 +2,249 @@ from pathlib import Path
 import sys
 import time
 from collections import deque
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 
-# get distance of two points
-def distance(p1, p2):
-    v = p1-p2
-    return np.sqrt(np.dot(v, v))
+# offsets of neighboring grid cells to be checked
+# half of 3x3 neighborhood (with cell itself), so that each pair of cells is checked once
+NEIGHBOR_CELLS = [(0, 0), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+# get all pairs of points within EPS, using uniform grid of EPS-sized cells
+# points in a cell are only compared with points in neighboring cells,
+# and distances are compared in squared form, vectorized over blocks of up to chunk_size pairs
+# returns index arrays (i, j) of pairs, each pair appears once
+def grid_neighbor_pairs(points, EPS, chunk_size=1<<22):
+    cells = np.floor(points/EPS).astype(np.int64)
+    cells -= cells.min(axis=0)
+    # padding of y cell index, so that y offset never wraps to another column
+    num_cell_y = cells.T[1].max() + 3
+    cell_keys = cells.T[0]*num_cell_y + cells.T[1] + 1
+
+    cell_order = np.argsort(cell_keys, kind='stable')
+    sorted_points = points[cell_order]
+    keys, cell_starts, cell_counts = np.unique(cell_keys[cell_order], return_index=True, return_counts=True)
+    point_cells = np.repeat(np.arange(keys.size), cell_counts)
+    eps_square = EPS*EPS
+
+    pairs_i = [np.zeros(0, dtype=np.int64)]
+    pairs_j = [np.zeros(0, dtype=np.int64)]
+    for dx, dy in NEIGHBOR_CELLS:
+        target_keys = keys + dx*num_cell_y + dy
+        target_cells = np.minimum(np.searchsorted(keys, target_keys), keys.size-1)
+        found = keys[target_cells] == target_keys
+        target_starts = np.where(found, cell_starts[target_cells], 0)
+        target_counts = np.where(found, cell_counts[target_cells], 0)
+
+        # candidate pairs of each point p are (p, target_start ... target_start+target_count-1)
+        point_counts = target_counts[point_cells]
+        point_ends = np.cumsum(point_counts)
+        chunk_start = 0
+        while chunk_start < point_counts.size:
+            base = point_ends[chunk_start-1] if chunk_start > 0 else 0
+            chunk_end = max(chunk_start+1, np.searchsorted(point_ends, base+chunk_size, side='right'))
+            counts = point_counts[chunk_start:chunk_end]
+
+            idx_i = np.repeat(np.arange(chunk_start, chunk_end), counts)
+            idx_j = np.arange(idx_i.size) - np.repeat(np.cumsum(counts)-counts, counts)
+            idx_j += np.repeat(target_starts[point_cells[chunk_start:chunk_end]], counts)
+            if dx == 0 and dy == 0:
+                upper = idx_j > idx_i
+                idx_i = idx_i[upper]
+                idx_j = idx_j[upper]
+
+            v = sorted_points[idx_i] - sorted_points[idx_j]
+            close = (v.T[0]*v.T[0] + v.T[1]*v.T[1]) <= eps_square
+            pairs_i.append(cell_order[idx_i[close]])
+            pairs_j.append(cell_order[idx_j[close]])
+            chunk_start = chunk_end
+
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+# get pairs within EPS of one tile (run in worker process)
+# points are sorted by x, tile owns points [0, num_owned) and the rest is its halo
+# pairs are kept only if smaller index is owned, so each pair is found by exactly one tile
+def tile_neighbor_pairs(args):
+    tile_start, points, num_owned, EPS = args
+    pairs_i, pairs_j = grid_neighbor_pairs(points, EPS)
+    owned = np.minimum(pairs_i, pairs_j) < num_owned
+
+    return pairs_i[owned] + tile_start, pairs_j[owned] + tile_start
+
+# get all pairs of points within EPS in process pool
+# points are sorted by x, and the plane is split into vertical tiles of same number of points
+# each tile has EPS-wide halo on its right side
+def parallel_neighbor_pairs(points, EPS, workers, tiles_per_worker=4):
+    num_tiles = max(1, min(points.shape[0], workers*tiles_per_worker))
+    bounds = np.linspace(0, points.shape[0], num_tiles+1).astype(np.int64)
+
+    tasks = []
+    for tile_start, tile_end in zip(bounds[:-1], bounds[1:]):
+        if tile_start == tile_end:
+            continue
+        halo_end = np.searchsorted(points.T[0], points[tile_end-1][0] + EPS, side='right')
+        tasks.append((tile_start, points[tile_start:halo_end], tile_end-tile_start, EPS))
+
+    pool = Pool(workers)
+    results = pool.map(tile_neighbor_pairs, tasks)
+    pool.close()
+    pool.join()
+
+    return np.concatenate([pairs_i for pairs_i, _ in results]), np.concatenate([pairs_j for _, pairs_j in results])
+
+# build CSR adjacency from pairs of neighboring points
+# neighbors of point p are neighbors[offsets[p]:offsets[p+1]],
+# ordered nearest in index order first among points before p, then points after p in index order
+def build_csr(num_points, pairs_i, pairs_j):
+    src = np.concatenate([pairs_i, pairs_j])
+    dst = np.concatenate([pairs_j, pairs_i])
+    before = dst < src
+    edge_order = np.lexsort((np.where(before, -dst, dst), ~before, src))
+
+    offset_dtype = np.int32 if src.size < np.iinfo(np.int32).max else np.int64
+    offsets = np.searchsorted(src[edge_order], np.arange(num_points+1)).astype(offset_dtype)
+    neighbors = dst[edge_order].astype(np.int32)
+
+    return offsets, neighbors
+
+# gather neighbors of given points in order (ragged gather over CSR)
+def gather_neighbors(offsets, neighbors, points):
+    starts = offsets[points]
+    counts = offsets[points+1] - starts
+    idx = np.arange(counts.sum()) + np.repeat(starts - np.cumsum(counts) + counts, counts)
+
+    return neighbors[idx]
+
+# index of all neighbor pairs within max_eps, sorted by distance
+# pairs within any EPS <= max_eps are prefix of pairs, so clustering for many (EPS, MinPTS) pairs
+# is derived from one neighbor search
+class NeighborIndex:
+    def __init__(self, points, max_eps, workers=1):
+        if workers > 1:
+            pairs_i, pairs_j = parallel_neighbor_pairs(points, max_eps, workers)
+        else:
+            pairs_i, pairs_j = grid_neighbor_pairs(points, max_eps)
+        # squared distances, computed as in neighbor search
+        v = points[pairs_i] - points[pairs_j]
+        dist_square = v.T[0]*v.T[0] + v.T[1]*v.T[1]
+
+        pair_order = np.argsort(dist_square, kind='stable')
+        self.num_points = points.shape[0]
+        self.max_eps = max_eps
+        self.pairs_i = pairs_i[pair_order]
+        self.pairs_j = pairs_j[pair_order]
+        self.dist_square = dist_square[pair_order]
+
+        # squared distance from each point to its k-th nearest neighbor within max_eps (inf if none)
+        src = np.concatenate([self.pairs_i, self.pairs_j])
+        edge_dists = np.concatenate([self.dist_square, self.dist_square])
+        edge_order = np.lexsort((edge_dists, src))
+        self.edge_offsets = np.searchsorted(src[edge_order], np.arange(self.num_points+1))
+        self.edge_dists = edge_dists[edge_order]
+        self.k_dists = {}
+
+    # pairs of points within eps
+    def pairs_within(self, eps):
+        num_pairs = np.searchsorted(self.dist_square, eps*eps, side='right')
+        return self.pairs_i[:num_pairs], self.pairs_j[:num_pairs]
+
+    # squared k-distance of each point, where point is core for MinPTS if its (MinPTS-1)-distance <= EPS
+    # cached for each k
+    def k_distances(self, k):
+        if not (k in self.k_dists):
+            if k <= 0:
+                self.k_dists[k] = np.zeros(self.num_points)
+            else:
+                has_k = np.diff(self.edge_offsets) >= k
+                k_dists = np.full(self.num_points, np.inf)
+                k_dists[has_k] = self.edge_dists[self.edge_offsets[:-1][has_k] + k-1]
+                self.k_dists[k] = k_dists
+
+        return self.k_dists[k]
 
 # DBSCAN clustering algorithm class
 class DBSCAN:
     # Constructor
-    def __init__(self, N, EPS, MinPTS):
+    # neighbor search is run in process pool if workers > 1
+    def __init__(self, N, EPS, MinPTS, workers=1):
         self.N = N
         self.EPS = EPS
         self.MinPTS = MinPTS
+        self.workers = workers
 
-        self.adjacent_list = {}
+        # objects are indexed in order sorted by x
+        # neighbor graph is kept as CSR arrays of object indices
+        self.obj_ids = None
+        self.points = None
+        self.offsets = None
+        self.neighbors = None
+        self.is_core = None
+
+        # state of incremental mode (see start_incremental)
+        self.positions = None
     
-    # read data and make adjacency list with this data
+    # read data, objects are sorted by x
+    def read_data(self, filename):
+        obj_ids, points = read_points(filename)
+
+        sort_idx = points.T[0].argsort()
+        self.obj_ids = obj_ids[sort_idx]
+        self.points = points[sort_idx]
+
+    # read data and make CSR adjacency with this data
     def set_data(self, filename):
         start_time = time.time()
-        data_set = pd.read_csv(filename, 
-                               sep='\t', 
-                               header=None).values
-
-        sort_idx = data_set.T[1].argsort()
-        data_set = data_set[sort_idx]
-
-        points = []
-        for obj in data_set:
-            obj_id = int(obj[0])
-            obj_point = np.array([obj[1], obj[2]])
-            self.adjacent_list[obj_id] = []
-
-            for neighbor_obj in reversed(points):
-                neighbor_id = neighbor_obj[0]
-                neighbor_point = neighbor_obj[1]
-                if obj_point[0] - neighbor_point[0]  > self.EPS:
-                    break
-
-                if distance(obj_point, neighbor_point) <= self.EPS:
-                    self.adjacent_list[obj_id].append(neighbor_id)
-                    self.adjacent_list[neighbor_id].append(obj_id)
-            
-            points.append((obj_id, obj_point))
+        self.read_data(filename)
+        points = self.points
+        if self.workers > 1:
+            pairs_i, pairs_j = parallel_neighbor_pairs(points, self.EPS, self.workers)
+        else:
+            pairs_i, pairs_j = grid_neighbor_pairs(points, self.EPS)
+        self.offsets, self.neighbors = build_csr(self.obj_ids.size, pairs_i, pairs_j)
+        self.is_core = np.diff(self.offsets) + 1 >= self.MinPTS
             
         end_time = time.time()
         print('Data Handling Time :', end_time - start_time)
 
-    # Get cluster 
-    # with BFS algorithm
-    def get_clusters(self):
+    # make CSR adjacency for current EPS and MinPTS from neighbor index, without neighbor search
+    def set_index(self, index):
+        self.offsets, self.neighbors = build_csr(self.obj_ids.size, *index.pairs_within(self.EPS))
+        self.is_core = index.k_distances(self.MinPTS-1) <= self.EPS*self.EPS
+
+    # find all clusters as arrays of object indices, in order of discovery
+    # with BFS algorithm, each level of BFS is expanded at once
+    # (same visiting order with queue based BFS)
+    def find_clusters(self):
         clusters = []
         
-        visited = set()
-        queue = deque([])
-        start_time = time.time()
-        for obj_id in self.adjacent_list:
-            if obj_id in visited or len(self.adjacent_list[obj_id]) + 1 < self.MinPTS:
+        visited = np.zeros(self.obj_ids.size, dtype=bool)
+        for seed in np.flatnonzero(self.is_core):
+            if visited[seed]:
                 continue
 
-            now_cluster = [obj_id]
-            visited.add(obj_id)
-            queue.append(obj_id)
+            now_cluster = [np.array([seed])]
+            visited[seed] = True
+            frontier = np.array([seed])
 
-            while queue:
-                now = queue.popleft()
-                
-                for nxt in self.adjacent_list[now]:
-                    if not (nxt in visited):
-                        visited.add(nxt)
-                        now_cluster.append(nxt)
-                        if len(self.adjacent_list[nxt]) + 1 >= self.MinPTS:
-                            queue.append(nxt)
+            while frontier.size > 0:
+                candidates = gather_neighbors(self.offsets, self.neighbors, frontier)
+                candidates = candidates[~visited[candidates]]
+                # keep first occurrence of each object, in visiting order
+                _, first = np.unique(candidates, return_index=True)
+                discovered = candidates[np.sort(first)]
+
+                visited[discovered] = True
+                now_cluster.append(discovered)
+                frontier = discovered[self.is_core[discovered]]
+
+            clusters.append(np.concatenate(now_cluster))
+
+        return clusters
 
-            clusters.append(now_cluster)
+    # Get N largest clusters as arrays of object ids
+    def get_clusters(self):
+        start_time = time.time()
+        clusters = [self.obj_ids[cluster] for cluster in self.find_clusters()]
 
         while len(clusters) < self.N:
             clusters.append([])
@@ -92,6 +259,202 @@ class DBSCAN:
         print('Traning Time :', end_time - start_time)
         return clusters
 
+    # key deciding order of objects in incremental mode (x, then id)
+    # seed of cluster is its core object with smallest key,
+    # and border object belongs to adjacent cluster with smallest seed, as BFS in sorted order does
+    def key_of(self, obj_id):
+        return (self.positions[obj_id][0], obj_id)
+
+    def cell_of(self, point):
+        return (int(np.floor(point[0]/self.EPS)), int(np.floor(point[1]/self.EPS)))
+
+    def is_core_obj(self, obj_id):
+        return len(self.adjacent[obj_id]) + 1 >= self.MinPTS
+
+    # switch to incremental mode
+    # neighbor graph and clusters are kept in dictionaries, which can be updated locally
+    # positions : object id -> point, cells : grid cell -> object ids, adjacent : object id -> neighbor ids
+    # labels : object id -> cluster label, members : cluster label -> object ids, seeds : cluster label -> key of seed
+    def start_incremental(self):
+        self.positions = {}
+        self.cells = {}
+        self.adjacent = {}
+        self.labels = {}
+        self.members = {}
+        self.seeds = {}
+        self.next_label = 0
+        if self.obj_ids is None:
+            return
+
+        obj_ids = self.obj_ids.tolist()
+        for idx, obj_id in enumerate(obj_ids):
+            point = (float(self.points[idx][0]), float(self.points[idx][1]))
+            self.positions[obj_id] = point
+            self.cells.setdefault(self.cell_of(point), set()).add(obj_id)
+            self.adjacent[obj_id] = set(self.obj_ids[self.neighbors[self.offsets[idx]:self.offsets[idx+1]]].tolist())
+
+        for cluster in self.find_clusters():
+            label = self.next_label
+            self.next_label += 1
+            self.members[label] = set(self.obj_ids[cluster].tolist())
+            for obj_id in self.members[label]:
+                self.labels[obj_id] = label
+            self.seeds[label] = min(self.key_of(obj_id) for obj_id in self.members[label] if self.is_core_obj(obj_id))
+
+    # insert new objects and update only affected neighborhoods and clusters
+    # inserting existing object moves it (it is deleted first), and last point of repeated id is used
+    def insert_points(self, obj_ids, points):
+        if self.positions is None:
+            self.start_incremental()
+
+        new_points = dict(zip(obj_ids, points))
+        moved = [obj_id for obj_id in new_points if obj_id in self.positions]
+        if moved:
+            self.delete_points(moved)
+
+        dirty = set()
+        eps_square = self.EPS*self.EPS
+        for obj_id, point in new_points.items():
+            point = (float(point[0]), float(point[1]))
+            cell = self.cell_of(point)
+            self.positions[obj_id] = point
+            self.adjacent[obj_id] = set()
+            for dx in (-1, 0, 1):
+                for dy in (-1, 0, 1):
+                    for neighbor_id in self.cells.get((cell[0]+dx, cell[1]+dy), ()):
+                        neighbor_point = self.positions[neighbor_id]
+                        vx = point[0]-neighbor_point[0]
+                        vy = point[1]-neighbor_point[1]
+                        if vx*vx + vy*vy <= eps_square:
+                            self.adjacent[obj_id].add(neighbor_id)
+                            self.adjacent[neighbor_id].add(obj_id)
+                            dirty.add(neighbor_id)
+            self.cells.setdefault(cell, set()).add(obj_id)
+            dirty.add(obj_id)
+
+        self.update_clusters(dirty, set())
+
+    # delete objects and update only affected neighborhoods and clusters
+    def delete_points(self, obj_ids):
+        if self.positions is None:
+            self.start_incremental()
+
+        dirty = set()
+        region_labels = set()
+        for obj_id in obj_ids:
+            if not (obj_id in self.positions):
+                continue
+            for neighbor_id in self.adjacent.pop(obj_id):
+                self.adjacent[neighbor_id].discard(obj_id)
+                dirty.add(neighbor_id)
+            cell = self.cell_of(self.positions.pop(obj_id))
+            self.cells[cell].discard(obj_id)
+            if not self.cells[cell]:
+                del self.cells[cell]
+            if obj_id in self.labels:
+                label = self.labels.pop(obj_id)
+                self.members[label].discard(obj_id)
+                region_labels.add(label)
+            dirty.discard(obj_id)
+
+        self.update_clusters(dirty, region_labels)
+
+    # recompute clusters around dirty objects (objects whose neighborhood changed)
+    # clusters touching dirty objects or their neighbors are dissolved and rebuilt,
+    # other clusters are kept as they are
+    def update_clusters(self, dirty, region_labels):
+        region = set(dirty)
+        for obj_id in dirty:
+            region.update(self.adjacent[obj_id])
+        for obj_id in region:
+            if obj_id in self.labels:
+                region_labels.add(self.labels[obj_id])
+        for label in region_labels:
+            region.update(self.members.pop(label))
+            del self.seeds[label]
+        for obj_id in region:
+            self.labels.pop(obj_id, None)
+
+        # cluster core objects of region, by BFS over core objects only
+        cores = sorted([obj_id for obj_id in region if self.is_core_obj(obj_id)], key=self.key_of)
+        borders = set()
+        for seed in cores:
+            if seed in self.labels:
+                continue
+            label = self.next_label
+            self.next_label += 1
+            self.members[label] = {seed}
+            self.seeds[label] = self.key_of(seed)
+            self.labels[seed] = label
+            queue = deque([seed])
+
+            while queue:
+                now = queue.popleft()
+                for nxt in self.adjacent[now]:
+                    if not self.is_core_obj(nxt):
+                        borders.add(nxt)
+                    elif not (nxt in self.labels):
+                        self.labels[nxt] = label
+                        self.members[label].add(nxt)
+                        queue.append(nxt)
+
+        # border object belongs to adjacent cluster with smallest seed
+        borders.update(obj_id for obj_id in region if not self.is_core_obj(obj_id))
+        for obj_id in borders:
+            owners = [self.labels[neighbor_id] for neighbor_id in self.adjacent[obj_id]
+                      if self.is_core_obj(neighbor_id) and neighbor_id in self.labels]
+            if obj_id in self.labels:
+                self.members[self.labels.pop(obj_id)].discard(obj_id)
+            if owners:
+                owner = min(owners, key=lambda label: self.seeds[label])
+                self.labels[obj_id] = owner
+                self.members[owner].add(obj_id)
+
+    # Get N largest clusters of incremental mode as lists of object ids
+    # ties are broken by seed, and objects are listed in key order
+    def get_current_clusters(self):
+        labels = sorted(self.members, key=lambda label: (-len(self.members[label]), self.seeds[label]))
+        clusters = [sorted(self.members[label], key=self.key_of) for label in labels[:self.N]]
+
+        while len(clusters) < self.N:
+            clusters.append([])
+
+        return clusters
+
+# read objects from input file
+# returns object ids and points
+def read_points(filename):
+    data_set = pd.read_csv(filename, 
+                           sep='\t', 
+                           header=None).values
+
+    return data_set.T[0].astype(np.int64), data_set[:, 1:3].astype(np.float64)
+
+# cluster with every (EPS, MinPTS) pair, reusing one neighbor index built for largest EPS
+# returns (EPS, MinPTS, number of clusters, number of noise objects, cluster sizes in descending order)
+def sweep_process(dbscan, eps_list, min_pts_list):
+    index = NeighborIndex(dbscan.points, max(eps_list), dbscan.workers)
+
+    records = []
+    for EPS in eps_list:
+        for MinPTS in min_pts_list:
+            dbscan.EPS = EPS
+            dbscan.MinPTS = MinPTS
+            dbscan.set_index(index)
+            sizes = sorted([cluster.size for cluster in dbscan.find_clusters()], reverse=True)
+            records.append((EPS, MinPTS, len(sizes), dbscan.obj_ids.size - sum(sizes), sizes))
+
+    return records
+
+# write sweep result, one line for each (EPS, MinPTS) pair
+# sizes of only n largest clusters are written
+def output_sweep(filename, records, n):
+    file = open(filename, mode='w')
+    file.write('EPS\tMinPTS\tclusters\tnoise\tsizes\n')
+    for EPS, MinPTS, num_clusters, num_noise, sizes in records:
+        file.write('%g\t%d\t%d\t%d\t%s\n' % (EPS, MinPTS, num_clusters, num_noise, ','.join(map(str, sizes[:n]))))
+    file.close()
+
 # write clustering result to output file
 def output_process(file_prefix, clusters, n):
     for cluster_id in range(n):
@@ -107,14 +470,48 @@ def output_process(file_prefix, clusters, n):
 
         file.close()
     
+# split command line arguments into positional arguments and options
+# option is given as '--name value'
+def parse_options(argv, defaults):
+    args = []
+    options = dict(defaults)
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('--') and argv[i][2:] in options and i+1 < len(argv):
+            options[argv[i][2:]] = argv[i+1]
+            i+=2
+        else:
+            args.append(argv[i])
+            i+=1
+
+    return args, options
+
 def main(argv):
+    argv, options = parse_options(argv, {'workers': '1', 'insert': '', 'delete': '', 'sweep-eps': '', 'sweep-min-pts': ''})
     if len(argv)<5:
         print('PLEASE, give 4 arguments (input filename, N, EPS, MinPTS)')
+        print('options : --workers N')
+        print('          --insert (filename of objects to insert), --delete (filename of object ids to delete)')
+        print('          --sweep-eps E1,E2,..., --sweep-min-pts M1,M2,... (EPS or MinPTS argument is used if not given)')
         return
 
     file_prefix = Path(argv[1]).stem
     
-    dbscan = DBSCAN(int(argv[2]), float(argv[3]), int(argv[4]))
+    dbscan = DBSCAN(int(argv[2]), float(argv[3]), int(argv[4]), int(options['workers']))
+
+    # sweep mode, report of clusterings for many (EPS, MinPTS) pairs is written instead of clusters
+    if options['sweep-eps'] or options['sweep-min-pts']:
+        eps_list = [float(EPS) for EPS in options['sweep-eps'].split(',')] if options['sweep-eps'] else [dbscan.EPS]
+        min_pts_list = [int(MinPTS) for MinPTS in options['sweep-min-pts'].split(',')] if options['sweep-min-pts'] else [dbscan.MinPTS]
+
+        start_time = time.time()
+        dbscan.read_data(argv[1])
+        records = sweep_process(dbscan, eps_list, min_pts_list)
+        end_time = time.time()
+        print('Sweep Time :', end_time - start_time)
+
+        output_sweep(file_prefix+'_sweep.txt', records, dbscan.N)
+        return
     
     start_time = time.time()
     dbscan.set_data(argv[1])
@@ -123,6 +520,19 @@ def main(argv):
     
     print('DBSCAN Time :', end_time - start_time)
 
+    # apply changes incrementally on top of clusters of input file
+    if options['insert'] or options['delete']:
+        start_time = time.time()
+        dbscan.start_incremental()
+        if options['delete']:
+            dbscan.delete_points(pd.read_csv(options['delete'], header=None).values.T[0].astype(np.int64).tolist())
+        if options['insert']:
+            obj_ids, points = read_points(options['insert'])
+            dbscan.insert_points(obj_ids.tolist(), points)
+        clusters = dbscan.get_current_clusters()
+        end_time = time.time()
+        print('Incremental Update Time :', end_time - start_time)
+
     output_process(file_prefix, clusters, int(argv[2]))
 
 if __name__ == '__main__':
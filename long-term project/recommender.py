@@ -1,92 +1,200 @@
 import sys
 import time
+from multiprocessing.pool import ThreadPool
 from os import path
 import numpy as np
 import pandas as pd
 
+# training ratings in sparse (COO) form
+# user and item ids are factorized into indices in sorted id order
+# user_idx, item_idx : int32 index arrays, ratings : float32 array, one entry per rating
+class RatingSet:
+    def __init__(self, dataset):
+        user_idx, self.user_ids = pd.factorize(dataset['user_id'], sort=True)
+        item_idx, self.item_ids = pd.factorize(dataset['item_id'], sort=True)
+
+        self.user_idx = user_idx.astype(np.int32)
+        self.item_idx = item_idx.astype(np.int32)
+        self.ratings = dataset['rating'].values.astype(np.float32)
+
+        self.num_user = self.user_ids.size
+        self.num_item = self.item_ids.size
+        self.n = self.ratings.size
+
+    # ratings grouped by user (or item) in CSR form
+    # ratings of i-th user are entries offsets[i]:offsets[i+1] of (other_idx, ratings)
+    def csr_of(self, by_user):
+        major_idx, minor_idx = (self.user_idx, self.item_idx) if by_user else (self.item_idx, self.user_idx)
+        num_major = self.num_user if by_user else self.num_item
+
+        order = np.argsort(major_idx, kind='stable')
+        offsets = np.searchsorted(major_idx[order], np.arange(num_major+1))
+
+        return offsets, minor_idx[order], self.ratings[order]
+
+# features of ratings, factors of other side with constant 1 (for bias)
+def features_of(fixed, other_idx):
+    return np.hstack([fixed[other_idx], np.ones((other_idx.size, 1))])
+
+# solve regularized least squares of rows [start, end) in CSR form (run in thread pool)
+# each row gets its factors and bias as one solution
+# regularization is scaled by number of ratings of row
+# Gram matrices of rows up to block_size ratings are summed from per-rating outer products at once,
+# longer rows are summed as X.T @ X over blocks, so temporary memory stays O(block_size)
+def solve_rows(args):
+    offsets, other_idx, targets, fixed, regularization, start, end, block_size = args
+    counts = np.diff(offsets[start:end+1])
+    A = np.zeros((end-start, fixed.shape[1]+1, fixed.shape[1]+1))
+    b = np.zeros((end-start, fixed.shape[1]+1))
+
+    short = np.flatnonzero(counts <= block_size)
+    if short.size > 0:
+        short_counts = counts[short]
+        row_offsets = np.cumsum(short_counts) - short_counts
+        idx = np.arange(short_counts.sum()) + np.repeat(offsets[start+short] - row_offsets, short_counts)
+
+        X = features_of(fixed, other_idx[idx])
+        A[short] = np.add.reduceat(X[:, :, None] * X[:, None, :], row_offsets)
+        b[short] = np.add.reduceat(X * targets[idx, None], row_offsets)
+
+    for row in np.flatnonzero(counts > block_size):
+        row_end = offsets[start+row+1]
+        for lo in range(offsets[start+row], row_end, block_size):
+            hi = min(lo+block_size, row_end)
+            X = features_of(fixed, other_idx[lo:hi])
+            A[row] += X.T @ X
+            b[row] += X.T @ targets[lo:hi]
+
+    A += regularization * counts[:, None, None] * np.eye(A.shape[1])
+
+    return np.linalg.solve(A, b[:, :, None])[:, :, 0]
+
+# split CSR rows into chunks of about chunk_size ratings
+def row_chunks(offsets, chunk_size):
+    bounds = np.searchsorted(offsets, np.arange(0, offsets[-1], chunk_size), side='right') - 1
+    bounds = np.unique(np.append(bounds, offsets.size-1))
+
+    return list(zip(bounds[:-1], bounds[1:]))
+
 # Recommender System Class (Matrix Multiplication)
 class Recommender:
     # Constructor
-    def __init__(self, rating_matrix, factor, learning_rate, regularization):
-        self.rating_matrix = rating_matrix.values
-        self.idx = np.array(self.rating_matrix.nonzero()).T
-        self.n = self.idx.size
+    def __init__(self, rating_set, factor, learning_rate, regularization):
+        self.rating_set = rating_set
+        self.n = rating_set.n
 
-        self.num_user = rating_matrix.shape[0]
-        self.num_item = rating_matrix.shape[1]
+        self.num_user = rating_set.num_user
+        self.num_item = rating_set.num_item
         self.factor = factor
         self.regularization = regularization
         
         self.learning_rate = learning_rate
 
-        self.user_idx_map = {}
-        self.item_idx_map = {}
+    
+    # Training Function
+    # using mini-batch Gradient Descent
+    # each epoch visits ratings in random order, batch_size ratings at once
+    # gradients of batch are computed from same parameters and scatter-added,
+    # so user or item appearing several times in batch gets sum of its updates
+    def train(self, num_iterations = 50, batch_size = 1024):
+        self.U = np.random.normal(scale=0.1, size=(self.num_user, self.factor))
+        self.V = np.random.normal(scale=0.1, size=(self.num_item, self.factor))
+
+        self.U_bias = np.zeros(self.num_user)
+        self.V_bias = np.zeros(self.num_item)
 
-        idx = 0
-        for user_id in rating_matrix.index:
-            self.user_idx_map[user_id] = idx
-            idx+=1
+        user_idx = self.rating_set.user_idx
+        item_idx = self.rating_set.item_idx
+        ratings = self.rating_set.ratings
+        self.bias = ratings.mean(dtype=np.float64)
+
+        for _ in range(num_iterations):
+            order = np.random.permutation(self.n)
+            for start in range(0, self.n, batch_size):
+                batch = order[start:start+batch_size]
+                self.train_batch(user_idx[batch], item_idx[batch], ratings[batch])
+
+    # one gradient step for batch of ratings
+    def train_batch(self, user_idx, item_idx, ratings):
+        U = self.U[user_idx]
+        V = self.V[item_idx]
+        U_bias = self.U_bias[user_idx]
+        V_bias = self.V_bias[item_idx]
+
+        error = ratings - (self.bias + U_bias + V_bias + np.einsum('ij,ij->i', U, V))
+
+        np.add.at(self.U_bias, user_idx, self.learning_rate * (error - self.regularization * U_bias))
+        np.add.at(self.V_bias, item_idx, self.learning_rate * (error - self.regularization * V_bias))
+
+        dU = error[:, None] * V - self.regularization * U
+        dV = error[:, None] * U - self.regularization * V
+
+        np.add.at(self.U, user_idx, self.learning_rate * dU)
+        np.add.at(self.V, item_idx, self.learning_rate * dV)
 
-        idx = 0
-        for item_id in rating_matrix.columns:
-            self.item_idx_map[item_id] = idx
-            idx+=1
-    
     # Training Function
-    # using Gradient Descent
-    def train(self, num_iterations = 50):
+    # using Alternating Least Squares
+    # user factors and biases are solved with item side fixed, then item side with user side fixed
+    # rows are solved independently in chunks, in thread pool if workers > 1
+    def train_als(self, num_iterations = 15, workers = 1, chunk_size = 1<<14):
         self.U = np.random.normal(scale=0.1, size=(self.num_user, self.factor))
         self.V = np.random.normal(scale=0.1, size=(self.num_item, self.factor))
 
         self.U_bias = np.zeros(self.num_user)
         self.V_bias = np.zeros(self.num_item)
 
-        self.bias = self.rating_matrix[self.rating_matrix != 0].mean()
+        self.bias = self.rating_set.ratings.mean(dtype=np.float64)
+
+        user_offsets, user_items, user_ratings = self.rating_set.csr_of(True)
+        item_offsets, item_users, item_ratings = self.rating_set.csr_of(False)
+        user_chunks = row_chunks(user_offsets, chunk_size)
+        item_chunks = row_chunks(item_offsets, chunk_size)
 
+        pool = ThreadPool(workers) if workers > 1 else None
         for _ in range(num_iterations):
-            np.random.shuffle(self.idx)
-            for user_id, item_id in self.idx:
-                predicted_rating = self.predict(user_id, item_id)
-                rating = self.rating_matrix[user_id][item_id]
+            targets = user_ratings - self.bias - self.V_bias[user_items]
+            solution = self.solve_all(pool, user_offsets, user_items, targets, self.V, user_chunks, chunk_size)
+            self.U, self.U_bias = solution[:, :-1], solution[:, -1]
+
+            targets = item_ratings - self.bias - self.U_bias[item_users]
+            solution = self.solve_all(pool, item_offsets, item_users, targets, self.U, item_chunks, chunk_size)
+            self.V, self.V_bias = solution[:, :-1], solution[:, -1]
 
-                error = rating - predicted_rating
+        if pool is not None:
+            pool.close()
+            pool.join()
 
-                self.U_bias[user_id] += self.learning_rate * (error - self.regularization * self.U_bias[user_id])
-                self.V_bias[item_id] += self.learning_rate * (error - self.regularization * self.V_bias[item_id])
+    # solve all rows of one side of ALS
+    def solve_all(self, pool, offsets, other_idx, targets, fixed, chunks, chunk_size):
+        tasks = [(offsets, other_idx, targets, fixed, self.regularization, start, end, chunk_size) for start, end in chunks]
+        results = pool.map(solve_rows, tasks) if pool is not None else list(map(solve_rows, tasks))
 
-                dU = error * self.V[item_id] - self.regularization * self.U[user_id]
-                dV = error * self.U[user_id] - self.regularization * self.V[item_id]
-                
-                self.U[user_id] += self.learning_rate * dU
-                self.V[item_id] += self.learning_rate * dV
+        return np.concatenate(results)
 
     # prediction function for single user-item pair   
     def predict(self, user_id, item_id):
         return self.bias + self.U_bias[user_id] + self.V_bias[item_id] + np.dot(self.U[user_id], self.V[item_id])
 
     # test function
+    # test ids are mapped to indices at once, and only predictions of test pairs are computed
+    # unknown item : mean prediction of user over all items, unknown user : global bias
     def test(self, test_dataset):
-        result = []
-        predicted_matrix = self.bias + np.array([self.U_bias]).T + np.array([self.V_bias]) + np.dot(self.U, self.V.T)
-        
-        for _, row in test_dataset.iterrows():
-            user_id = row['user_id']
-            item_id = row['item_id']
+        user_idx = self.rating_set.user_ids.get_indexer(test_dataset['user_id'])
+        item_idx = self.rating_set.item_ids.get_indexer(test_dataset['item_id'])
+        known_user = user_idx >= 0
+        known_item = item_idx >= 0
 
-            predicted_rating = None
+        result = np.full(len(test_dataset), self.bias)
 
-            if user_id in self.user_idx_map:
-                user_idx = self.user_idx_map[user_id]
-                if item_id in self.item_idx_map:
-                    item_idx = self.item_idx_map[item_id]
+        pair = known_user & known_item
+        U = self.U[user_idx[pair]]
+        V = self.V[item_idx[pair]]
+        result[pair] = self.bias + self.U_bias[user_idx[pair]] + self.V_bias[item_idx[pair]] + np.einsum('ij,ij->i', U, V)
 
-                    predicted_rating = min(5, max(1, predicted_matrix[user_idx][item_idx]))
-                else:
-                    predicted_rating = min(5, max(1, predicted_matrix[user_idx].mean()))
-            else:
-                predicted_rating = self.bias
+        only_user = known_user & ~known_item
+        result[only_user] = self.bias + self.U_bias[user_idx[only_user]] + self.V_bias.mean() + np.dot(self.U[user_idx[only_user]], self.V.mean(axis=0))
 
-            result.append(predicted_rating)
+        result[known_user] = np.clip(result[known_user], 1, 5)
         
         return result
 
@@ -102,33 +210,60 @@ def read_data(filename):
     return df
 
 # write test result to output file
+# lines are made with vectorized string operations and written at once
+# clipped ratings (1 or 5) are written as integers
 def output_process(filename, test_dataset, test_result):
+    ratings = np.where(test_result == np.round(test_result), 
+                       test_result.astype(np.int64).astype(str), 
+                       test_result.astype(str))
+    lines = np.char.add(np.char.add(test_dataset['user_id'].values.astype(str), '\t'), 
+                        np.char.add(np.char.add(test_dataset['item_id'].values.astype(str), '\t'), ratings))
+
     file = open(filename, mode='w')
-    
-    for idx, row in test_dataset.iterrows():
-        file.write(str(row['user_id']))
-        file.write('\t')
-        file.write(str(row['item_id']))
-        file.write('\t')
-        file.write(str(test_result[idx]))
+    if lines.size > 0:
+        file.write('\n'.join(lines.tolist()))
         file.write('\n')
+    file.close()
+
+# split command line arguments into positional arguments and options
+# option is given as '--name value'
+def parse_options(argv, defaults):
+    args = []
+    options = dict(defaults)
+    i = 0
+    while i < len(argv):
+        if argv[i].startswith('--') and argv[i][2:] in options and i+1 < len(argv):
+            options[argv[i][2:]] = argv[i+1]
+            i+=2
+        else:
+            args.append(argv[i])
+            i+=1
+
+    return args, options
 
 def main(argv):
-    if len(argv)<3:
+    argv, options = parse_options(argv, {'solver': 'sgd', 'workers': '1'})
+    if len(argv)<3 or not (options['solver'] in ('sgd', 'als')):
         print('PLEASE, give 2 arguments (train filename, test filename)')
+        print('options : --solver sgd|als, --workers N (als only)')
+        return
+    if int(options['workers']) > 1 and options['solver'] != 'als':
+        print('--workers is only supported with als solver')
         return
 
     train_dataset = read_data(argv[1])
     test_dataset = read_data(argv[2])
 
-    rating_matrix = pd.pivot_table(train_dataset, 
-                                   index='user_id', 
-                                   columns='item_id', 
-                                   values='rating').fillna(0)
+    rating_set = RatingSet(train_dataset)
     
-    recommender = Recommender(rating_matrix, 10, 0.005, 0.05)
+    # ALS solves to convergence without early stopping of SGD, so it needs stronger regularization
+    regularization = 0.1 if options['solver'] == 'als' else 0.05
+    recommender = Recommender(rating_set, 10, 0.005, regularization)
     start_time = time.time()
-    recommender.train()
+    if options['solver'] == 'als':
+        recommender.train_als(workers=int(options['workers']))
+    else:
+        recommender.train()
     end_time = time.time()
     print('Training Time : ', end_time-start_time)
     